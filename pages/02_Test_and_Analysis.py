@@ -1,7 +1,12 @@
 import streamlit as st
 from src.utils import prepare_logs
 from src.model import TemperatureModel, get_mae, get_rmse, select_features_from_temperature_window
+from src.leaderboard import build_leaderboard
+from src.drift import check_drift
+from src.kpis import compare_modules, update_rollups
+from src.tracing import TRACE_ENV, load_traces, summarize_traces, tracing_enabled
 import json
+import pandas as pd
 
 config = json.load(open("config.json", "r"))
 
@@ -27,7 +32,7 @@ with st.expander("Model test"):
         with st.spinner("Model validation in progress..."):
             module_name = log_runs.loc[model_index, "module_name"]
             model = TemperatureModel(module_config=config[module_name])
-            pred_df = model.predict(log_runs.loc[model_index, "parameters"])
+            pred_df = model.predict_logged_run(log_runs.loc[model_index])
             st.dataframe(model.features_df)
             st.dataframe(pred_df)
 
@@ -55,8 +60,58 @@ with st.expander("Residuals analysis"):
         with st.spinner("Model validation in progress..."):
             module_name = log_runs.loc[model_index, "module_name"]
             model = TemperatureModel(module_config=config[module_name])
-            pred_df = model.predict(log_runs.loc[model_index, "parameters"])
+            pred_df = model.predict_logged_run(log_runs.loc[model_index])
             pred_df, correlation = build_residuals(pred_df)
             st.dataframe(pred_df)
             st.write(correlation)
             
+
+with st.expander("Leaderboard"):
+    with st.form("Leaderboard"):
+        module_names = st.multiselect("Modules to score (all by default)", list(config.keys()))
+        btn = st.form_submit_button("Score all runs")
+    if btn:
+        with st.spinner("Scoring runs on latest data..."):
+            leaderboard = build_leaderboard(config, module_names=module_names or None)
+            st.dataframe(leaderboard)
+
+with st.expander("Drift monitor"):
+    with st.form("Drift monitor"):
+        module_names = st.multiselect("Modules to check (all by default)", list(config.keys()))
+        refresh_data = st.toggle("Fetch new data first")
+        btn = st.form_submit_button("Check drift")
+    if btn:
+        with st.spinner("Updating residual statistics..."):
+            statuses = check_drift([config[module_name] for module_name in module_names or config.keys()], refresh_data=refresh_data)
+            st.dataframe(pd.DataFrame(statuses).assign(reasons=lambda df: df["reasons"].str.join("; ")))
+
+with st.expander("Energy KPIs"):
+    cols = st.columns([1, 1, 4])
+    with cols[0]:
+        period = st.selectbox("Period", ["Month", "Day", "Hour"])
+    with cols[1]:
+        if st.button("Refresh rollups"):
+            for module_config in config.values():
+                try:
+                    update_rollups(module_config)
+                except FileNotFoundError:
+                    st.warning(f"No data for {module_config['module_name']}")
+    kpis = compare_modules(list(config.values()), {"Month": "MS", "Day": "D", "Hour": "h"}[period])
+    st.dataframe(kpis[["uptime_h", "kwh", "hdd", "kwh_per_hdd", "temperature_int", "temperature_ext"]])
+    if len(kpis.index) > 0:
+        st.bar_chart(kpis["kwh"].unstack(level=0), y_label="kWh")
+
+with st.expander("Pipeline traces"):
+    if not tracing_enabled():
+        st.info(f"Tracing is off, start the app (or the scheduler) with {TRACE_ENV}=1 to record traces")
+    traces = load_traces()
+    if len(traces.index) > 0:
+        cols = st.columns(2)
+        with cols[0]:
+            modules = ["all"] + sorted(traces["tag_module"].dropna().unique()) if "tag_module" in traces.columns else ["all"]
+            module = st.selectbox("Module", modules)
+        with cols[1]:
+            by = st.selectbox("Group by", ["path", "name"])
+        if module != "all":
+            traces = traces[traces["tag_module"] == module]
+        st.dataframe(summarize_traces(traces, by=(by,)))
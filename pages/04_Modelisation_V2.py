@@ -1,13 +1,15 @@
 import streamlit as st
-from src.model import TemperatureModel, get_rmse, get_mae
+from src.model import MODEL_FAMILIES, TemperatureModel, get_rmse, get_mae
 import plotly.graph_objects as go
 from src.sandbox import Simulation
+from src.experts import ExpertBank, DEFAULT_TEMPERATURE_EDGES
 from src.data_loader import update_db
 import json
 import datetime as dt
 import pandas as pd
 from src.utils import prepare_logs
 from src.validation import validate_model
+from src.plotting import downsample, line_traces, zoom_range_slider
 
 st.set_page_config(
     page_title='Modelisation V2', 
@@ -28,37 +30,31 @@ if st.button("update databases"):
     update_db(config["chauvigny"])
     st.success("Databases updated")
 
-def plot_temperatures(features_df: pd.DataFrame):
+def plot_temperatures(features_df: pd.DataFrame, x_range=None):
     """
     Plot the evolution of different temperature metrics over time.
 
     Args:
         features_df (pd.DataFrame): DataFrame containing temperature data.
+        x_range (list): [start, end] range to plot, downsampled to the chart resolution. Whole history by default.
     """
-    fig = go.Figure()
-    for c in ['temperature_int', 'temperature_ext', 'all_day_temperature', 'roll5_avg_temperature']:
-        fig.add_trace(
-            go.Scatter(
-                x=features_df['date'],
-                y=features_df[c],
-                name=c,
-            )
-        )
-        fig.update_layout(
-            title='Temp evolution',
-            xaxis_title='Date',
-            yaxis_title='Temperature (°C)',
-            legend_title='Legend',
-        )
+    fig = go.Figure(line_traces(features_df, ['temperature_int', 'temperature_ext', 'all_day_temperature', 'roll5_avg_temperature'], x_range=x_range))
+    fig.update_layout(
+        title='Temp evolution',
+        xaxis_title='Date',
+        yaxis_title='Temperature (°C)',
+        legend_title='Legend',
+    )
     st.plotly_chart(fig)
 
-def plot_pred(pred_df, parameters):
+def plot_pred(pred_df, parameters, x_range=None):
     """
     Plot the predicted temperatures and other relevant metrics.
 
     Args:
         pred_df (pd.DataFrame): DataFrame containing prediction data.
         parameters (list): List of parameters used in the prediction model.
+        x_range (list): [start, end] range to plot, downsampled to the chart resolution. Whole history by default.
     """
     col1, col2 = st.columns([1, 6])
     with col1:
@@ -68,18 +64,10 @@ def plot_pred(pred_df, parameters):
         st.metric("Pvoisin", parameters[3], border=True)
         st.metric("delta_t", parameters[4], border=True)
     with col2:
-        fig = go.Figure()
-        for c in ['temperature_int', 'T_int_pred', 'direct_radiation', 'temperature_ext', 'all_day_temperature']:
-            fig.add_trace(
-                go.Scatter(
-                    x=pred_df['date'],
-                    y=pred_df[c],
-                    name=c,
-                )
-            )
-        is_heating_df = pred_df[pred_df.state=='on']
+        fig = go.Figure(line_traces(pred_df, ['temperature_int', 'T_int_pred', 'direct_radiation', 'temperature_ext', 'all_day_temperature'], x_range=x_range))
+        is_heating_df = downsample(pred_df[pred_df.state=='on'], 'is_heating', x_range=x_range)
         fig.add_trace(
-            go.Scatter(
+            go.Scattergl(
                 x=is_heating_df['date'],
                 y=is_heating_df['is_heating'],
                 name="is_heating",
@@ -89,24 +77,6 @@ def plot_pred(pred_df, parameters):
         st.metric("RMSE", round(get_rmse(pred_df), 2), border=True)
         st.plotly_chart(fig)
 
-def get_params_from_model(log_runs, module_name):
-    """
-    Retrieve the parameters from the most recent model run for a given module.
-
-    Args:
-        log_runs (pd.DataFrame): DataFrame containing log runs.
-        module_name (str): Name of the module for which to retrieve parameters.
-
-    Returns:
-        list: List of parameters from the most recent model run for the specified module.
-    """
-    df = (
-        log_runs[log_runs["module_name"] == module_name].copy()
-        .sort_values(by='date', ascending=False)
-        .reset_index(drop=True)
-    )
-    return df.iloc[0]['parameters']
-
 with st.expander("See models performance"):
     with st.form("Model perfo"):
         log_runs = prepare_logs()
@@ -120,9 +90,13 @@ with st.expander("See models performance"):
         module_name = log_runs.loc[model_index, "module_name"]
         model = TemperatureModel(module_config=config[module_name])
         parameters = log_runs.loc[model_index, "parameters"]
-        prediction_df = model.predict(parameters)
-        model.plot_paintings(parameters)
-        plot_pred(prediction_df, parameters)
+        # Kept across reruns: moving the zoom slider redraws the charts without predicting again
+        st.session_state["model_perfo"] = (model, parameters, model.predict_logged_run(log_runs.loc[model_index]))
+    if "model_perfo" in st.session_state:
+        model, parameters, prediction_df = st.session_state["model_perfo"]
+        x_range = zoom_range_slider(prediction_df, key="model_perfo_zoom")
+        model.plot_paintings(parameters, x_range=x_range)
+        plot_pred(prediction_df, parameters, x_range=x_range)
 
 with st.expander("Train a model - single run"):
     with st.form("Optimal parameters"):
@@ -140,6 +114,12 @@ with st.expander("Train a model - single run"):
             temp_min = st.slider("Temperature Window min", min_value=-20, max_value=30, value=0)
             temp_max = st.slider("Temperature Window max", min_value=-20, max_value=30, value=0)
             expert_model_temp = st.toggle("Train expert model ? (use temperature window)")
+        with cols[0]:
+            warm_start = st.toggle("Refit from latest run")
+            model_family = st.selectbox("Model family", list(MODEL_FAMILIES.keys()))
+            coarse_step = st.selectbox("Coarse-to-fine first stage", ["off", "15 min", "30 min"])
+            event_driven = st.toggle("Fit on raw readings (event-driven, 1R1C)")
+            last_n_days = st.number_input("Refit on last N days (0 = all)", min_value=0, value=0)
         submitted = st.form_submit_button("Train model")
         if submitted:
             model = TemperatureModel(module_config=config[module_name])
@@ -153,9 +133,39 @@ with st.expander("Train a model - single run"):
                 temp_min = None
                 temp_max = None
             with st.spinner("Parameters optimisation in progress..."):
-                model.get_optimal_parameters(train_timeframe=train_timeframe, temp_min=temp_min, temp_max=temp_max)
+                model.get_optimal_parameters(
+                    train_timeframe=train_timeframe,
+                    temp_min=temp_min,
+                    temp_max=temp_max,
+                    warm_start=warm_start,
+                    last_n_days=last_n_days or None,
+                    model_family=model_family,
+                    coarse_factor={"off": None, "15 min": 3, "30 min": 6}[coarse_step],
+                    event_driven=event_driven,
+                )
             st.success("Done!")
 
+with st.expander("Train a bank of expert models"):
+    with st.form("Expert bank"):
+        cols = st.columns([1, 2])
+        with cols[0]:
+            module_name = st.selectbox("Which model to train", set(config.keys()))
+        with cols[1]:
+            edges = st.text_input("Temperature band edges (°C)", value=", ".join(str(edge) for edge in DEFAULT_TEMPERATURE_EDGES))
+        submitted = st.form_submit_button("Train expert bank")
+        if submitted:
+            model = TemperatureModel(module_config=config[module_name])
+            with st.spinner("Training one expert per temperature band..."):
+                bank = ExpertBank(edges=[float(edge) for edge in edges.split(",") if edge.strip()]).fit(model)
+                bank.log(model)
+            st.dataframe(pd.DataFrame(
+                bank.parameters,
+                columns=["R", "C", "alpha", "Pvoisin", "time_shift"],
+                index=[f"{temp_min} -> {temp_max}" for temp_min, temp_max in bank.bands()],
+            ).assign(expert_used=bank.lookup, nfev=bank.nfev))
+            st.metric("RMSE (expert bank)", round(get_rmse(bank.predict(model)), 2), border=True)
+            st.success(f"Done! Logged as {bank.group_id}")
+
 validation_button = st.button("Validate model")
 if validation_button:
     with st.spinner("Model validation in progress..."):
@@ -220,6 +230,7 @@ with st.expander("See scenario output"):
             model_index = st.selectbox("Select model to test", list(log_runs.index), 0)
         with cols[2]:
             scenario = st.selectbox("Scenario", ["teletravail", "normal", "off"])
+            ensemble = st.toggle("Weather uncertainty (ensemble of 500 members)")
         btn = st.form_submit_button("Submit")
     if btn:
         module_name = log_runs.loc[model_index, "module_name"]
@@ -233,3 +244,6 @@ with st.expander("See scenario output"):
         simu.create_simulation_features(heating_scenario=scenario)
         simu.compute_temperature_int()
         plot_simu(simu)
+        if ensemble:
+            st.markdown("### Scenarios under weather uncertainty")
+            st.dataframe(simu.compute_scenarios_ensemble(n_members=500))
@@ -0,0 +1,63 @@
+import argparse
+import json
+import subprocess
+import sys
+
+# This file guards the headless startup of src/: each core module is imported in a fresh interpreter, its import
+# time is measured and the run fails when it pulled in the UI stack (streamlit, plotly), or when it is slower
+# than --max-seconds.
+# Run with: python -m src.benchmark_imports
+
+HEADLESS_MODULES = [
+    "src.model",
+    "src.optimizer",
+    "src.data_loader",
+    "src.features",
+    "src.sandbox",
+    "src.scheduler",
+    "src.online",
+    "src.service",
+]
+UI_MODULES = ["streamlit", "plotly"]
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "ui_modules": [m for m in {ui_modules} if m in sys.modules]}}))
+"""
+
+
+def measure_import(module, repeat=3):
+    """Best import time of module over repeat fresh interpreters, and the UI modules it imported."""
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_SCRIPT.format(module=module, ui_modules=UI_MODULES)],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {"module": module, "seconds": min(run["seconds"] for run in runs), "ui_modules": runs[0]["ui_modules"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import time of the headless modules of src/.")
+    parser.add_argument("modules", nargs="*", help="Modules to import, HEADLESS_MODULES by default")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-seconds", type=float, default=None, help="Fail when a module takes longer to import")
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules or HEADLESS_MODULES:
+        result = measure_import(module, args.repeat)
+        problems = [f"imports {', '.join(result['ui_modules'])}"] if result["ui_modules"] else []
+        if args.max_seconds is not None and result["seconds"] > args.max_seconds:
+            problems.append(f"slower than {args.max_seconds} s")
+        failed = failed or bool(problems)
+        print(f"{module:<20} {result['seconds']:.3f} s  {'FAIL: ' + ', '.join(problems) if problems else 'ok'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
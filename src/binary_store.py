@@ -0,0 +1,202 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# This file is the binary alternative to the CSV files of data/<db_name>/.
+# Each entity is stored as one append-only file per column under data/<db_name>/bin/<entity>/:
+# - date.i64: epoch in ns, always sorted
+# - <column>.f32: numeric values (temperatures, radiation, ...)
+# - <column>.u8: string states (on/off, ...), codes into the labels listed in schema.json (at most 256)
+# Reads memory-map the files: no timestamp parsing, and a date window only touches the rows it needs.
+# Select it per module with "storage": "binary" in config.json, CSV stays the default.
+
+INVALID_STATES = ['unknown', 'unavailable']
+COLUMN_DTYPES = {"i64": np.int64, "f32": np.float32, "u8": np.uint8}
+MAX_LABELS = np.iinfo(np.uint8).max + 1 # distinct states a u8 column can code
+
+
+class BinaryStore:
+    """
+    Append-only, memory-mapped column storage for the sensor history of one module.
+
+    Attributes:
+        db_path (str): Database folder of the module, data/<db_name>.
+    Methods:
+        append(entity, df_new): Appends the rows of df_new newer than the last stored date.
+        read(entity, start=None, end=None, previous=False): Returns the entity as a DataFrame, optionally restricted to [start, end).
+        import_csv(entity, csv_path=None): Appends the content of the entity's CSV file.
+        export_csv(entity, csv_path=None): Writes the entity back to CSV.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def entity_path(self, entity):
+        return os.path.join(self.db_path, "bin", entity)
+
+    def exists(self, entity):
+        return os.path.exists(os.path.join(self.entity_path(entity), "schema.json"))
+
+    def load_schema(self, entity):
+        with open(os.path.join(self.entity_path(entity), "schema.json"), "r") as f:
+            return json.load(f)
+
+    def save_schema(self, entity, schema):
+        path = os.path.join(self.entity_path(entity), "schema.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(schema, f, indent=4)
+        os.replace(path + ".tmp", path)
+
+    def column_file(self, entity, column, kind):
+        return os.path.join(self.entity_path(entity), f"{column}.{kind}")
+
+    def map_column(self, entity, column, kind):
+        path = self.column_file(entity, column, kind)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return np.empty(0, dtype=COLUMN_DTYPES[kind])
+        return np.memmap(path, dtype=COLUMN_DTYPES[kind], mode="r")
+
+    def append(self, entity, df_new: pd.DataFrame):
+        """
+        Append df_new to the entity, with the same cleaning as populate_database.
+        Being append-only, rows older than or equal to the last stored date are dropped.
+        The schema is inferred from the first non-empty batch: a column is f32 when all its values are numeric.
+
+        Args:
+            entity (str): Entity name (temperature_int, switch, weather, ...).
+            df_new (pd.DataFrame): New rows, with a date column.
+
+        Returns:
+            int: Number of appended rows.
+
+        Raises:
+            ValueError: When a string column would get more than MAX_LABELS distinct states.
+        """
+        df_new = df_new.assign(date=lambda df: pd.to_datetime(df["date"], utc=True))
+        for c in df_new.columns:
+            df_new = df_new[~df_new[c].isin(INVALID_STATES)]
+        df_new = df_new.sort_values("date").drop_duplicates("date")
+
+        if self.exists(entity):
+            schema = self.load_schema(entity)
+        elif len(df_new.index) == 0:
+            return 0 # an empty batch tells nothing about the column types, the schema waits for real rows
+        else:
+            os.makedirs(self.entity_path(entity), exist_ok=True)
+            schema = {"columns": {}, "labels": {}}
+            for c in df_new.columns:
+                if c == "date":
+                    schema["columns"][c] = "i64"
+                elif (pd.to_numeric(df_new[c], errors="coerce").notna() | df_new[c].isna()).all():
+                    schema["columns"][c] = "f32"
+                else:
+                    schema["columns"][c] = "u8"
+                    schema["labels"][c] = []
+
+        dates = pd.DatetimeIndex(df_new["date"]).as_unit("ns").asi8
+        stored_dates = self.map_column(entity, "date", "i64")
+        if len(stored_dates):
+            keep = dates > stored_dates[-1]
+            df_new, dates = df_new[keep], dates[keep]
+        del stored_dates
+        if len(df_new.index) == 0:
+            self.save_schema(entity, schema)
+            return 0
+
+        columns = {}
+        for c, kind in schema["columns"].items():
+            if c == "date":
+                continue
+            if kind == "f32":
+                columns[c] = pd.to_numeric(df_new[c], errors="coerce").to_numpy(dtype=np.float32)
+            else:
+                labels = schema["labels"][c]
+                values = df_new[c].astype(str)
+                labels += [label for label in values.unique() if label not in labels]
+                if len(labels) > MAX_LABELS:
+                    raise ValueError(f"{entity}.{c} has {len(labels)} distinct states, the binary store codes at most {MAX_LABELS}")
+                columns[c] = values.map({label: code for code, label in enumerate(labels)}).to_numpy(dtype=np.uint8)
+        self.save_schema(entity, schema)
+        # Dates are written last: readers size every column on date.i64, so a partial append is never seen
+        for c, values in columns.items():
+            with open(self.column_file(entity, c, schema["columns"][c]), "ab") as f:
+                f.write(values.tobytes())
+        with open(self.column_file(entity, "date", "i64"), "ab") as f:
+            f.write(dates.tobytes())
+        return len(dates)
+
+    def read(self, entity, start=None, end=None, previous=False):
+        """
+        Read the entity, optionally restricted to start <= date < end, through binary search on the dates.
+        With previous, the last row before start is read too: a switch state or reading holds until the next row.
+
+        Returns:
+            pd.DataFrame: Same columns as the CSV file, with a UTC date column and float64 values.
+        """
+        schema = self.load_schema(entity)
+        dates = self.map_column(entity, "date", "i64")
+        lower = 0 if start is None else int(np.searchsorted(dates, to_epoch_ns(start), side="left"))
+        if previous:
+            lower = max(lower - 1, 0)
+        upper = len(dates) if end is None else int(np.searchsorted(dates, to_epoch_ns(end), side="left"))
+        data = {}
+        for c, kind in schema["columns"].items():
+            if c == "date":
+                data[c] = pd.to_datetime(np.asarray(dates[lower:upper]), utc=True)
+            elif kind == "f32":
+                data[c] = self.map_column(entity, c, kind)[lower:upper].astype(np.float64)
+            else:
+                labels = np.array(schema["labels"][c], dtype=object)
+                data[c] = labels[self.map_column(entity, c, kind)[lower:upper]]
+        return pd.DataFrame(data)
+
+    def import_csv(self, entity, csv_path=None):
+        csv_path = csv_path or os.path.join(self.db_path, f"{entity}.csv")
+        return self.append(entity, pd.read_csv(csv_path, sep=","))
+
+    def export_csv(self, entity, csv_path=None):
+        csv_path = csv_path or os.path.join(self.db_path, f"{entity}.csv")
+        df = self.read(entity)
+        schema = self.load_schema(entity)
+        for c, kind in schema["columns"].items():
+            if kind == "f32":
+                df[c] = df[c].astype(np.float32) # written with float32 precision, as stored
+        df.to_csv(csv_path, index=False)
+
+
+def to_epoch_ns(date):
+    """Epoch in ns of a date string or timestamp, naive dates being UTC."""
+    date = pd.Timestamp(date)
+    date = date.tz_localize("UTC") if date.tzinfo is None else date.tz_convert("UTC")
+    return date.as_unit("ns").value
+
+
+def module_entities(module_config):
+    return list(module_config["entities"]) + ["weather"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a module's database between CSV and binary storage.")
+    parser.add_argument("direction", choices=["import", "export"], help="import: CSV to binary, export: binary to CSV")
+    parser.add_argument("modules", nargs="*", help="Modules to convert, all modules of the config by default")
+    parser.add_argument("--config", default="config.json")
+    args = parser.parse_args()
+
+    config = json.load(open(args.config, "r"))
+    for module_name in args.modules or list(config.keys()):
+        module_config = config[module_name]
+        store = BinaryStore(f"data/{module_config["db_name"]}")
+        for entity in module_entities(module_config):
+            if args.direction == "import":
+                if os.path.exists(os.path.join(store.db_path, f"{entity}.csv")):
+                    print(f"{module_name}/{entity}: {store.import_csv(entity)} rows imported")
+            elif store.exists(entity):
+                store.export_csv(entity)
+                print(f"{module_name}/{entity}: exported")
+
+
+if __name__ == "__main__":
+    main()
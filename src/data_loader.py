@@ -1,12 +1,13 @@
 import datetime as dt
-import streamlit as st
+import numpy as np
 import pandas as pd
 import json
 import os
-from retry_requests import retry
-import openmeteo_requests
-import requests_cache
 import requests
+import hashlib
+from src.binary_store import BinaryStore
+from src.tracing import current_span, entity_tags, module_tags, traced
+from src.ui import get_secret, st
 
 
 ENTITY_IDS_CAUSSA = [
@@ -39,6 +40,7 @@ def parse_data_string(data_string: str) -> dict:
     except json.JSONDecodeError as e:
         raise ValueError(f"Invalid JSON string: {e}")
 
+@traced(tags=entity_tags)
 def get_json_data(module_config, entity_id="", historic_length=10):
     """
     Get data from the Home Assistant API through GET REQUEST
@@ -51,7 +53,7 @@ def get_json_data(module_config, entity_id="", historic_length=10):
 
     url = f"{module_config["HA_domain_name"]}/api/history/period/{start_date}{end_date}{entity_id_query}"
 
-    TOKEN = st.secrets[module_config["API_TOKEN"]]
+    TOKEN = get_secret(module_config["API_TOKEN"])
     headers = {
         "Authorization": f"Bearer " + TOKEN
     }
@@ -66,6 +68,7 @@ def json_to_df(inputs, column_names):
         )
     return df
 
+@traced(tags=lambda df_new, csv_path: {"path": csv_path})
 def populate_database(df_new: pd.DataFrame, csv_path: str):
     """
     Populate or update a CSV file with new data, avoiding duplicates.
@@ -86,10 +89,92 @@ def populate_database(df_new: pd.DataFrame, csv_path: str):
         df_combined = df_combined.sort_values('date')
         
         df_combined.to_csv(csv_path, index=False)
+        current_span().set(rows=len(df_combined.index))
     else:
         # If file doesn't exist, save the new DataFrame
         df_new.to_csv(csv_path, index=False)
+        current_span().set(rows=len(df_new.index))
 
+@traced(tags=lambda df_new, module_config, entity: entity_tags(module_config, entity))
+def store_entity_data(df_new: pd.DataFrame, module_config: dict, entity: str):
+    """
+    Save new data of an entity in the module's storage backend, CSV by default or binary
+    when module_config["storage"] is "binary" (see src/binary_store.py).
+
+    Args:
+        df_new (pd.DataFrame): New DataFrame to add to the existing data.
+        module_config (dict): Configuration dictionary containing module-specific settings.
+        entity (str): Entity name (temperature_int, switch, weather, ...).
+    """
+    if module_config.get("storage", "csv") == "binary":
+        BinaryStore(f"data/{module_config["db_name"]}").append(entity, df_new)
+    else:
+        populate_database(df_new, f"data/{module_config["db_name"]}/{entity}.csv")
+
+@traced(tags=entity_tags)
+def load_entity_data(module_config: dict, entity: str, start=None, end=None) -> pd.DataFrame:
+    """
+    Load the stored data of an entity from the module's storage backend.
+    With start or end, only the rows from start (and the last row before it, its state or value holds until
+    the next row) to end (excluded) are returned: the binary store only reads those rows.
+
+    Args:
+        module_config (dict): Configuration dictionary containing module-specific settings.
+        entity (str): Entity name (temperature_int, switch, weather, ...).
+        start, end (str or pd.Timestamp): Date window, naive dates being UTC. None for no bound.
+
+    Returns:
+        pd.DataFrame: Stored data, with the same columns as the CSV file.
+    """
+    if module_config.get("storage", "csv") == "binary":
+        return BinaryStore(f"data/{module_config["db_name"]}").read(entity, start, end, previous=start is not None)
+    df = pd.read_csv(f"data/{module_config["db_name"]}/{entity}.csv", sep=",")
+    if start is None and end is None:
+        return df
+    return select_entity_window(df, start, end)
+
+def select_entity_window(df, start=None, end=None):
+    """Rows of a stored entity from start to end (excluded), and the last row before start."""
+    dates = pd.to_datetime(df["date"], utc=True, format="ISO8601")
+    keep = np.ones(len(df.index), dtype=bool)
+    if start is not None:
+        before = (dates < to_utc_timestamp(start)).to_numpy()
+        keep = ~before
+        if before.any():
+            keep |= (dates == dates[before].max()).to_numpy()
+    if end is not None:
+        keep &= (dates < to_utc_timestamp(end)).to_numpy()
+    return df[keep]
+
+def to_utc_timestamp(date):
+    """pd.Timestamp of date in UTC, naive dates being UTC."""
+    date = pd.Timestamp(date)
+    return date.tz_localize("UTC") if date.tzinfo is None else date.tz_convert("UTC")
+
+def get_data_version(module_config: dict) -> str:
+    """
+    Identify the current state of a module's stored data from the size and modification time of its files,
+    without reading them. Any update_db or storage change gives a new version.
+
+    Args:
+        module_config (dict): Configuration dictionary containing module-specific settings.
+
+    Returns:
+        str: Short hash of the data files state.
+    """
+    db_path = f"data/{module_config["db_name"]}"
+    if module_config.get("storage", "csv") == "binary":
+        db_path = os.path.join(db_path, "bin")
+    file_states = []
+    for root, dirs, files in os.walk(db_path):
+        if module_config.get("storage", "csv") != "binary" and root == db_path:
+            dirs[:] = [d for d in dirs if d not in ("bin", "kpis")] # kpis are derived from the data
+        for file in sorted(files):
+            stat = os.stat(os.path.join(root, file))
+            file_states.append(f"{os.path.join(root, file)}:{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.sha1("\n".join(sorted(file_states)).encode()).hexdigest()[:12]
+
+@traced(tags=module_tags)
 def get_weather_data(module_config: dict, past_days: int=5, forecast_days: int=3):
     """
     Retrieve past weather data using the Open-Meteo API.
@@ -102,6 +187,11 @@ def get_weather_data(module_config: dict, past_days: int=5, forecast_days: int=3
     Returns:
         pd.DataFrame: DataFrame containing past weather data.
     """
+    # Open-Meteo client libraries are only needed here, they are not imported with the module
+    from retry_requests import retry
+    import openmeteo_requests
+    import requests_cache
+
     # Setup the Open-Meteo API client with cache and retry on error
     cache_session = requests_cache.CachedSession('.cache', expire_after = 3600)
     retry_session = retry(cache_session, retries = 5, backoff_factor = 0.2)
@@ -138,12 +228,17 @@ def get_weather_data(module_config: dict, past_days: int=5, forecast_days: int=3
     hourly_dataframe = pd.DataFrame(data = hourly_data)
     return hourly_dataframe
 
-def update_db(module_config: dict):
+@traced(tags=module_tags)
+def update_db(module_config: dict, drift: bool=True, refit: bool=False):
     """
     Request data from Home Assistant and update the database.
 
     Args:
         module_config (dict): Configuration dictionary containing module-specific settings.
+        drift (bool): Check the drift of the module's latest run on the newly completed days (see src/drift.py),
+            with a warning giving its reasons when the module needs a refit.
+        refit (bool): Refit the module right away when it drifts (warm start, fleet scheduler), instead of leaving
+            it to python -m src.drift --refit.
     """
     for entity, entity_id in module_config["entities"].items():
         if "temperature" in entity:
@@ -153,13 +248,34 @@ def update_db(module_config: dict):
         try:
             json_data = get_json_data(module_config, entity_id, historic_length=10)
             df = json_to_df(json_data, column_names=column_names)
-            populate_database(df, f"data/{module_config["db_name"]}/{entity}.csv")
+            store_entity_data(df, module_config, entity)
         except Exception as e:
             st.error(f"Error while updating {entity} database: {e}")
             
     try:
     # weather
         df = get_weather_data(module_config,past_days=10, forecast_days=3)
-        populate_database(df, f"data/{module_config["db_name"]}/weather.csv")
+        store_entity_data(df, module_config, "weather")
+    except Exception as e:
+            st.error(f"Error while updating weather database: {e}")
+
+    try:
+        # KPI rollups are derived from the stored data, imported here as src.kpis reads it through this module
+        from src.kpis import update_rollups
+        update_rollups(module_config)
     except Exception as e:
-            st.error(f"Error while updating weather database: {e}")
\ No newline at end of file
+        st.error(f"Error while updating KPI rollups: {e}")
+
+    if drift:
+        try:
+            # Imported here for the same reason, check_drift only loads the days added since its last check
+            from src.drift import check_drift
+            status = check_drift([module_config])[0]
+            if status["refit"]:
+                st.warning(f"{module_config['module_name']} needs a refit: {'; '.join(status['reasons'])}")
+                if refit:
+                    from src.scheduler import FleetScheduler
+                    report = FleetScheduler([module_config], warm_start=True).run()[0]
+                    st.info(f"Refit of {module_config['module_name']}: {report['status']} {report['message']}")
+        except Exception as e:
+            st.error(f"Error while checking drift: {e}")
\ No newline at end of file
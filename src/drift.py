@@ -0,0 +1,322 @@
+import argparse
+import ast
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.data_loader import update_db
+from src.features import compile_features, predict_arrays
+from src.model import TemperatureModel, select_features_from_temperature_window
+from src.utils import prepare_logs
+
+# This file decides which modules need a refit, instead of retraining the whole fleet on a schedule.
+# For each module, the residuals temperature_int - T_int_pred of its latest logged 1R1C run are accumulated day by day
+# on the days after the run (out of sample): a day is only predicted once, when it is complete (predictions restart
+# from the measured temperature every day, so a day does not depend on the previous ones). The monitor keeps
+# exponentially weighted daily statistics and asks for a refit when:
+# - error: the recent RMSE exceeds error_ratio times the run's RMSE on its own training selection
+#   (train_timeframe, else the temp_min..temp_max window, else all the data before the run)
+# - bias: the recent mean residual exceeds max_bias degrees
+# - regime: the recent days mostly have an all_day_temperature outside the run's temperature window
+#   (temp_min..temp_max, else the range of its training days)
+# A new logged run resets the module's statistics. States are saved in data/logs/drift_state.json.
+# Only the days after the last checked one are loaded (TemperatureModel with start): update_db checks the drift
+# after each ingestion at the cost of the new data, warns when a refit is needed and runs it with refit=True.
+# Run with: python -m src.drift [modules] [--update-db] [--refit]
+
+logger = logging.getLogger(__name__)
+
+DRIFT_STATE_PATH = "data/logs/drift_state.json"
+DAY = 24 * 3600 * 10**9 # ns
+
+
+def daily_residuals(arrays, parameters):
+    """
+    Residual statistics of each day of compiled arrays.
+
+    Returns:
+        pd.DataFrame: One row per day (day as YYYY-MM-DD) with rows (measured rows), mse, bias (mean residual)
+            and all_day_temperature (the day's mean).
+    """
+    residuals = arrays["temperature_int"] - predict_arrays(arrays, parameters)
+    day_starts = arrays["day_starts"]
+    measured = ~np.isnan(residuals)
+    # Sums per day with np.add.reduceat, NaN residuals count for nothing
+    sums = lambda values: np.add.reduceat(values, day_starts[:-1]) if len(day_starts) > 1 else np.array([])
+    rows = sums(measured.astype(np.float64))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return pd.DataFrame({
+            "day": pd.to_datetime(arrays["date"][day_starts[:-1]], utc=True).strftime("%Y-%m-%d"),
+            "rows": rows.astype(int),
+            "mse": sums(np.where(measured, residuals, 0) ** 2) / rows,
+            "bias": sums(np.where(measured, residuals, 0)) / rows,
+            "all_day_temperature": sums(np.nan_to_num(arrays["all_day_temperature"])) / sums((~np.isnan(arrays["all_day_temperature"])).astype(np.float64)),
+        })
+
+
+def run_timeframe(run):
+    """train_timeframe of a runs.csv row as a list, None when the run was not fitted on a timeframe."""
+    train_timeframe = run.get("train_timeframe")
+    if not isinstance(train_timeframe, str) or not train_timeframe:
+        return None
+    return ast.literal_eval(train_timeframe)
+
+
+def run_bound(run, name):
+    bound = run.get(name)
+    return None if bound is None or pd.isna(bound) else float(bound)
+
+
+class DriftMonitor:
+    """
+    Incremental residual statistics of one module's latest logged run, see the header of this file.
+
+    Attributes:
+        module_config (dict): Configuration dictionary containing module-specific settings, defined in config.json.
+        state (dict): Saved statistics: run_date, parameters, baseline_rmse, window, last_day, days,
+            ewma_mse, ewma_bias, ewma_outside and the latest daily rows.
+        error_ratio (float): Refit when the recent RMSE exceeds error_ratio * baseline_rmse.
+        max_bias (float): Refit when the recent mean residual exceeds max_bias degrees (absolute value).
+        max_outside (float): Refit when more than this share of recent days is outside the temperature window.
+        halflife_days (float): Half-life of the exponentially weighted statistics.
+        min_days (int): Days after the run before any refit is asked.
+    Methods:
+        training_days(run, model=None): Daily residuals of a run on its own training selection.
+        update(model=None, run=None): Adds the newly completed days and returns the status.
+        status(): Current statistics, refit decision and its reasons.
+    """
+
+    def __init__(self, module_config, state=None, error_ratio=1.5, max_bias=1.0, max_outside=0.5, halflife_days=3, min_days=2):
+        self.module_config = module_config
+        self.state = state or {}
+        self.error_ratio = error_ratio
+        self.max_bias = max_bias
+        self.max_outside = max_outside
+        self.halflife_days = halflife_days
+        self.min_days = min_days
+
+    @property
+    def module_name(self):
+        return self.module_config["module_name"]
+
+    def latest_run(self):
+        log_runs = prepare_logs()
+        log_runs = log_runs[(log_runs["module_name"] == self.module_name) & (log_runs["model"] == "1R1C")]
+        if len(log_runs.index) == 0:
+            return None
+        return log_runs.sort_values("date").iloc[-1]
+
+    def training_days(self, run, model=None):
+        """
+        Daily residuals of a run on the rows it was fitted on, selected as TemperatureModel.get_optimal_parameters
+        does: train_timeframe, else the temp_min..temp_max window, else all data (only the data before the run).
+
+        Args:
+            run (pd.Series): runs.csv row (from prepare_logs).
+            model (TemperatureModel): Model of the module with all its data, built when not given.
+        """
+        train_timeframe = run_timeframe(run)
+        if train_timeframe:
+            # Single [start, end] windows only load their data, unions of windows load everything
+            start = train_timeframe[0] if not isinstance(train_timeframe[0], (list, tuple)) else None
+            model = model or TemperatureModel(self.module_config, start=start)
+            features_df = model.select_timeframe(model.features_df, train_timeframe)
+        else:
+            model = model or TemperatureModel(self.module_config)
+            features_df = model.select_timeframe(model.features_df, [None, run["date"].strftime("%Y-%m-%d")])
+            temp_min, temp_max = run_bound(run, "temp_min"), run_bound(run, "temp_max")
+            if temp_min or temp_max:
+                window_df = select_features_from_temperature_window(features_df, temp_min, temp_max)
+                features_df = window_df if len(window_df.index) else features_df # the fit used all data then
+        return daily_residuals(compile_features(features_df, model.P_consigne), [float(p) for p in run["parameters"]])
+
+    def reset(self, run, training):
+        """Start the statistics of a new run from its baseline: RMSE and temperature window over its training_days."""
+        run_day = run["date"].strftime("%Y-%m-%d")
+        training = training[training["rows"] > 0]
+        if run_bound(run, "temp_min") is not None or run_bound(run, "temp_max") is not None:
+            window = [run_bound(run, "temp_min"), run_bound(run, "temp_max")]
+        else:
+            window = [float(training["all_day_temperature"].min()), float(training["all_day_temperature"].max())] if len(training.index) else [None, None]
+        self.state = {
+            "run_date": str(run["date"]),
+            "parameters": [float(p) for p in run["parameters"]],
+            "baseline_rmse": float(np.sqrt((training["mse"] * training["rows"]).sum() / training["rows"].sum())) if training["rows"].sum() else None,
+            "window": window,
+            "last_day": run_day, # the run's own day may hold training data
+            "days": 0,
+            "ewma_mse": None,
+            "ewma_bias": None,
+            "ewma_outside": None,
+            "daily": [],
+        }
+
+    def outside_window(self, temperatures):
+        lower, upper = self.state["window"]
+        outside = np.zeros(len(temperatures), dtype=bool)
+        if lower is not None:
+            outside |= temperatures < lower
+        if upper is not None:
+            outside |= temperatures > upper
+        return outside
+
+    def update(self, model=None, run=None):
+        """
+        Add the days completed since the last update (the newest day is left for later, it is still filling).
+
+        Args:
+            model (TemperatureModel): Model of the module with up to date data, only the data after the last
+                checked day (and the run's training data on a new run) is loaded when not given.
+            run (pd.Series): runs.csv row (from prepare_logs) to monitor, the module's latest 1R1C run by default.
+
+        Returns:
+            dict: status()
+        """
+        run = self.latest_run() if run is None else run
+        if run is None:
+            self.state = {}
+            return self.status()
+        if self.state.get("run_date") != str(run["date"]):
+            self.reset(run, self.training_days(run, model))
+
+        # Only the rows of new complete days are loaded and predicted
+        start = pd.Timestamp(self.state["last_day"], tz="UTC") + pd.Timedelta(days=1)
+        if start >= pd.Timestamp.now(tz="UTC").floor("D"):
+            return self.status()
+        model = model or TemperatureModel(self.module_config, start=start)
+        features_df = model.features_df[model.features_df["date"] >= start]
+        arrays = compile_features(features_df, model.P_consigne)
+        dates = arrays["date"]
+        last_complete = np.searchsorted(dates, dates[-1] // DAY * DAY, side="left") if len(dates) else 0
+        if last_complete == 0:
+            return self.status()
+        days = daily_residuals(compile_features(features_df.iloc[:last_complete], model.P_consigne), self.state["parameters"])
+        days = days[days["rows"] > 0]
+        days = days.assign(outside=self.outside_window(days["all_day_temperature"].to_numpy()))
+
+        weight = 1 - 0.5 ** (1 / self.halflife_days)
+        for day in days.itertuples():
+            for key, value in [("ewma_mse", day.mse), ("ewma_bias", day.bias), ("ewma_outside", float(day.outside))]:
+                previous = self.state[key]
+                self.state[key] = float(value) if previous is None else previous + weight * (float(value) - previous)
+            self.state["days"] += 1
+            self.state["daily"] = (self.state["daily"] + [{
+                "day": day.day, "rmse": float(np.sqrt(day.mse)), "bias": float(day.bias),
+                "all_day_temperature": float(day.all_day_temperature), "outside": bool(day.outside),
+            }])[-30:]
+        if len(days.index):
+            self.state["last_day"] = days["day"].iloc[-1]
+        return self.status()
+
+    def status(self):
+        """Current statistics of the module, with refit (bool) and the reasons for it."""
+        state = self.state
+        if not state:
+            return {"module_name": self.module_name, "refit": False, "reasons": ["no logged run"]}
+        recent_rmse = None if state["ewma_mse"] is None else float(np.sqrt(state["ewma_mse"]))
+        reasons = []
+        if state["days"] >= self.min_days:
+            if state["baseline_rmse"] and recent_rmse > self.error_ratio * state["baseline_rmse"]:
+                reasons.append(f"error: recent RMSE {recent_rmse:.2f} > {self.error_ratio} x {state['baseline_rmse']:.2f}")
+            if abs(state["ewma_bias"]) > self.max_bias:
+                reasons.append(f"bias: recent mean residual {state['ewma_bias']:+.2f} °C")
+            if state["ewma_outside"] > self.max_outside:
+                reasons.append(f"regime: {state['ewma_outside']:.0%} of recent days outside {state['window']}")
+        return {
+            "module_name": self.module_name,
+            "refit": bool(reasons),
+            "reasons": reasons,
+            "run_date": state["run_date"],
+            "days": state["days"],
+            "last_day": state["last_day"],
+            "baseline_rmse": state["baseline_rmse"],
+            "recent_rmse": recent_rmse,
+            "recent_bias": state["ewma_bias"],
+            "recent_outside": state["ewma_outside"],
+            "window": state["window"],
+        }
+
+
+def load_states(path=DRIFT_STATE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_states(states, path=DRIFT_STATE_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(states, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def check_drift(module_configs, refresh_data=False, path=DRIFT_STATE_PATH, **thresholds):
+    """
+    Update the drift statistics of modules and save them.
+
+    Args:
+        module_configs (list): Module configurations, as defined in config.json.
+        refresh_data (bool): Run update_db on each module first (without its own drift check).
+        path (str): JSON file of the saved states.
+        **thresholds: DriftMonitor thresholds (error_ratio, max_bias, max_outside, halflife_days, min_days).
+
+    Returns:
+        list: One DriftMonitor.status() per module, with a "message" instead when the update failed.
+    """
+    states = load_states(path)
+    statuses = []
+    for module_config in module_configs:
+        monitor = DriftMonitor(module_config, states.get(module_config["module_name"]), **thresholds)
+        try:
+            if refresh_data:
+                update_db(module_config, drift=False)
+            statuses.append(monitor.update())
+            states[monitor.module_name] = monitor.state
+        except Exception as e:
+            logger.warning(f"Drift check failed for {monitor.module_name}: {e}")
+            statuses.append({"module_name": monitor.module_name, "refit": False, "reasons": [], "message": f"Failed: {e}"})
+    save_states(states, path)
+    return statuses
+
+
+def main():
+    from src.scheduler import FleetScheduler
+
+    parser = argparse.ArgumentParser(description="Check the drift of each module's latest run and refit the drifting ones.")
+    parser.add_argument("modules", nargs="*", help="Modules to check, all modules of the config by default")
+    parser.add_argument("--config", default="config.json")
+    parser.add_argument("--update-db", action="store_true", help="Fetch new data from Home Assistant first")
+    parser.add_argument("--refit", action="store_true", help="Refit the drifting modules with the fleet scheduler")
+    parser.add_argument("--last-n-days", type=int, default=None, help="Refit on the newest N days of data")
+    parser.add_argument("--error-ratio", type=float, default=1.5)
+    parser.add_argument("--max-bias", type=float, default=1.0)
+    parser.add_argument("--max-outside", type=float, default=0.5)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    config = json.load(open(args.config, "r"))
+    module_names = args.modules or list(config.keys())
+    statuses = check_drift(
+        [config[module_name] for module_name in module_names],
+        refresh_data=args.update_db,
+        error_ratio=args.error_ratio,
+        max_bias=args.max_bias,
+        max_outside=args.max_outside,
+    )
+    for status in statuses:
+        detail = status.get("message") or "; ".join(status["reasons"]) or f"ok, recent RMSE {status.get('recent_rmse')}"
+        print(f"{status['module_name']:<20} {'REFIT' if status['refit'] else 'keep':<6} {detail}")
+
+    drifting = [config[status["module_name"]] for status in statuses if status["refit"]]
+    if args.refit and drifting:
+        reports = FleetScheduler(drifting, warm_start=True, last_n_days=args.last_n_days).run()
+        for report in reports:
+            print(f"{report['module_name']:<20} {report['status']:<10} nfev={report.get('nfev')} elapsed={report.get('elapsed')}")
+
+
+if __name__ == "__main__":
+    main()
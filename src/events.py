@@ -0,0 +1,185 @@
+import numpy as np
+import pandas as pd
+
+from src.binary_store import to_epoch_ns
+from src.data_loader import load_entity_data
+from src.features import TIME_STEP
+from src.optimizer import optimize_parameters
+
+# This file runs the RC model on the raw timestamps instead of the 5-minute grid of data_processing.
+# Inputs are piecewise constant: the state only needs to be propagated at their change points (switch transitions,
+# hourly weather updates, day starts), with the exact decay exp(-dt / (R * C)) of each interval. Sensor readings
+# are not steps: the temperature at a reading is evaluated from the start of its interval, and the loss only
+# uses actual readings instead of interpolated 5-minute values.
+# As TemperatureModel.predict, each day restarts from the measured temperature (interpolated at the day start)
+# and the switch acts time_shift * 5 minutes after its transitions.
+
+DAY = 24 * 3600 * 10**9 # ns
+
+
+class EventEngine:
+    """
+    Event-driven RC model on irregular timestamps.
+
+    Attributes:
+        reading_dates (np.ndarray): int64 epoch ns of the temperature_int readings, sorted.
+        readings (np.ndarray): Measured temperature_int.
+        loss_weights (np.ndarray): Weights of get_custom_loss at each reading.
+        switch_dates, switch_on (np.ndarray): Switch transitions and the state they switch to.
+        weather_dates, temperature_ext, direct_radiation (np.ndarray): Weather updates, radiation scaled as in
+            prepare_weather_df.
+        P_consigne (float): Consigne power value.
+    Methods:
+        segments(time_shift): Returns the intervals between change points for a time shift (cached).
+        predict(parameters): Returns the predicted temperature at each reading.
+        predict_df(parameters): Same as a DataFrame with date, temperature_int and T_int_pred.
+        custom_loss(parameters): Weighted squared error over the readings.
+        fit(initial_guess, options=None): Optimizes the parameters on the event loss.
+        from_module(module_config, timeframe=None): Builds the engine from the module's stored data.
+    """
+
+    def __init__(self, temperature_int_df, switch_df, weather_df, P_consigne):
+        readings = (
+            temperature_int_df
+            .assign(date=lambda df: pd.to_datetime(df["date"], utc=True), temperature=lambda df: pd.to_numeric(df["temperature"], errors="coerce"))
+            .dropna(subset=["temperature"])
+            .sort_values("date")
+            .drop_duplicates("date")
+        )
+        dates = pd.DatetimeIndex(readings["date"]).as_unit("ns")
+        self.reading_dates = dates.asi8
+        self.readings = readings["temperature"].to_numpy(dtype=np.float64)
+        self.loss_weights = (1 + (dates.hour.to_numpy() * 60 + dates.minute.to_numpy()) / 1435 * 5).astype(np.float64)
+
+        switch = switch_df.assign(date=lambda df: pd.to_datetime(df["date"], utc=True)).sort_values("date")
+        switch_on = (switch["state"] == "on").to_numpy()
+        transitions = np.r_[True, switch_on[1:] != switch_on[:-1]] if len(switch_on) else np.array([], dtype=bool)
+        self.switch_dates = pd.DatetimeIndex(switch["date"]).as_unit("ns").asi8[transitions]
+        self.switch_on = switch_on[transitions].astype(np.float64)
+
+        weather = weather_df.assign(date=lambda df: pd.to_datetime(df["date"], utc=True)).sort_values("date").drop_duplicates("date")
+        self.weather_dates = pd.DatetimeIndex(weather["date"]).as_unit("ns").asi8
+        self.temperature_ext = weather["temperature_2m"].to_numpy(dtype=np.float64)
+        self.direct_radiation = weather["direct_radiation"].to_numpy(dtype=np.float64) / 20
+
+        self.P_consigne = P_consigne
+        self._segments = {}
+
+    @classmethod
+    def from_module(cls, module_config, timeframe=None):
+        """Engine on the module's stored data, restricted to readings within timeframe = [start, end] when given."""
+        temperature_int_df = load_entity_data(module_config, "temperature_int")
+        if timeframe is not None:
+            dates = pd.to_datetime(temperature_int_df["date"], utc=True).astype("int64")
+            start, end = timeframe
+            keep = np.ones(len(dates), dtype=bool)
+            if start is not None:
+                keep &= dates >= to_epoch_ns(start)
+            if end is not None:
+                keep &= dates < to_epoch_ns(end)
+            temperature_int_df = temperature_int_df[keep]
+        return cls(
+            temperature_int_df,
+            load_entity_data(module_config, "switch"),
+            load_entity_data(module_config, "weather"),
+            module_config["P_consigne"],
+        )
+
+    def day_starts(self):
+        """Start of each day holding readings (midnight UTC, or the first reading), and the temperature there."""
+        if len(self.reading_dates) == 0:
+            return np.array([], dtype=np.int64), np.array([])
+        days = np.unique(self.reading_dates // DAY) * DAY
+        starts = np.maximum(days, self.reading_dates[0])
+        return starts, np.interp(starts, self.reading_dates, self.readings)
+
+    def segments(self, time_shift):
+        """
+        Intervals between change points for a time shift, as (days x segments) matrices padded with empty intervals.
+
+        Returns:
+            dict:
+                - start: int64 start of each interval
+                - duration: length in seconds (0 for padding)
+                - temperature_ext, direct_radiation, is_heating: inputs over the interval
+                - T0: temperature at the start of each day
+                - reading_day, reading_segment, reading_offset: interval of each reading and seconds since its start
+                - n_steps: number of change points, the steps of the simulation
+        """
+        shift = int(time_shift)
+        if shift in self._segments:
+            return self._segments[shift]
+        day_starts, T0 = self.day_starts()
+        switch_dates = self.switch_dates + shift * TIME_STEP * 10**9
+        end = self.reading_dates[-1] + 1 if len(self.reading_dates) else 0
+        changes = np.unique(np.r_[self.weather_dates, switch_dates, day_starts])
+        changes = changes[(changes >= (day_starts[0] if len(day_starts) else 0)) & (changes < end)]
+        day_of_change = np.searchsorted(day_starts, changes, side="right") - 1
+        day_ends = np.r_[day_starts[1:], end]
+        # Days start at midnight: every day start is itself a change point, the first of its day
+        first = np.searchsorted(changes, day_starts)
+        counts = np.diff(np.r_[first, len(changes)])
+        columns = np.arange(len(changes)) - np.repeat(first, counts)
+        durations = (np.r_[changes[1:], end] - changes) / 10**9
+        last = np.r_[first[1:], len(changes)] - 1
+        durations[last] = (day_ends - changes[last]) / 10**9
+
+        weather_position = np.searchsorted(self.weather_dates, changes, side="right") - 1
+        switch_position = np.searchsorted(switch_dates, changes, side="right") - 1
+        shape = (len(day_starts), counts.max() if len(counts) else 0)
+        segments = {"start": np.zeros(shape, dtype=np.int64), "duration": np.zeros(shape)}
+        inputs = {
+            "temperature_ext": np.where(weather_position >= 0, self.temperature_ext[np.maximum(weather_position, 0)], np.nan),
+            "direct_radiation": np.where(weather_position >= 0, self.direct_radiation[np.maximum(weather_position, 0)], np.nan),
+            "is_heating": np.where(switch_position >= 0, self.switch_on[np.maximum(switch_position, 0)], 0.0),
+        }
+        segments["start"][day_of_change, columns] = changes
+        segments["duration"][day_of_change, columns] = durations
+        for key, values in inputs.items():
+            segments[key] = np.zeros(shape)
+            segments[key][day_of_change, columns] = values
+        segments["T0"] = T0
+
+        reading_day = np.searchsorted(day_starts, self.reading_dates, side="right") - 1
+        reading_change = np.searchsorted(changes, self.reading_dates, side="right") - 1
+        segments["reading_day"] = reading_day
+        segments["reading_segment"] = columns[reading_change]
+        segments["reading_offset"] = (self.reading_dates - changes[reading_change]) / 10**9
+        segments["n_steps"] = len(changes)
+        self._segments[shift] = segments
+        return segments
+
+    def predict(self, parameters):
+        """Predicted temperature at each reading."""
+        R, C, alpha, P_voisin, time_shift = parameters[:5]
+        segments = self.segments(time_shift)
+        temperature_ext = segments["temperature_ext"]
+        Tlim = temperature_ext + R * (
+            self.P_consigne * segments["is_heating"] +
+            alpha * segments["direct_radiation"] +
+            P_voisin * (15 - temperature_ext)
+        )
+        decay = np.exp(-segments["duration"] / (R * C))
+        T_start = np.empty(Tlim.shape)
+        if T_start.size == 0:
+            return np.full(len(self.readings), np.nan)
+        T_start[:, 0] = segments["T0"]
+        for k in range(1, T_start.shape[1]):
+            T_start[:, k] = Tlim[:, k - 1] + (T_start[:, k - 1] - Tlim[:, k - 1]) * decay[:, k - 1]
+        day, segment = segments["reading_day"], segments["reading_segment"]
+        Tlim_reading = Tlim[day, segment]
+        return Tlim_reading + (T_start[day, segment] - Tlim_reading) * np.exp(-segments["reading_offset"] / (R * C))
+
+    def predict_df(self, parameters):
+        return pd.DataFrame({
+            "date": pd.to_datetime(self.reading_dates, utc=True),
+            "temperature_int": self.readings,
+            "T_int_pred": self.predict(parameters),
+        })
+
+    def custom_loss(self, parameters):
+        return np.nanmean((self.readings - self.predict(parameters)) ** 2 * self.loss_weights)
+
+    def fit(self, initial_guess, options=None, log=None):
+        """Same as optimize_parameters on the event loss."""
+        return optimize_parameters(loss_function=self.custom_loss, initial_guess=initial_guess, options=options, log=log)
@@ -0,0 +1,173 @@
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+from src.data_loader import populate_database
+from src.features import optimize_shared_features, predict_arrays, select_rows
+from src.model import DEFAULT_INITIAL_GUESS, RUNS_LOG_PATH
+from src.utils import EXPERT_MODEL, prepare_logs
+
+# This file trains a bank of "expert models", one per band of all_day_temperature, instead of one expert
+# per manual form submit. Experts are trained in parallel on shared feature arrays and logged in runs.csv
+# as a group (same group_id). At predict time each day goes to its expert through a band lookup table.
+
+DEFAULT_TEMPERATURE_EDGES = [0, 5, 10, 15] # °C, bands are (-inf, 0), [0, 5), ..., [15, +inf)
+MIN_DAYS_PER_EXPERT = 2
+
+
+class ExpertBank:
+    """
+    A group of expert models, each one fitted on the days whose all_day_temperature falls in its band.
+
+    Attributes:
+        edges (list): Band edges, band k is [edges[k-1], edges[k]) with open ends.
+        parameters (np.ndarray): (bands x 5) parameters, NaN rows for bands without expert.
+        lookup (np.ndarray): Expert used for each band, the nearest trained band when a band has no expert.
+        group_id (str): Identifier shared by the runs.csv rows of the bank.
+    Methods:
+        bands(): Returns the (temp_min, temp_max) of each band, None for open ends.
+        band_of(temperatures): Returns the band of each temperature (-1 for NaN).
+        fit(model, ...): Trains one expert per band in parallel.
+        log(model, ...): Writes the bank in runs.csv.
+        predict_arrays(arrays): Predicts with the expert of each day.
+        predict(model): Same as TemperatureModel.predict, with the expert of each day.
+        from_logs(module_name, group_id=None): Loads a logged bank, the latest one by default.
+    """
+
+    def __init__(self, edges=DEFAULT_TEMPERATURE_EDGES, parameters=None, group_id=None):
+        self.edges = [float(edge) for edge in sorted(edges)]
+        self.parameters = np.full((len(self.edges) + 1, 5), np.nan) if parameters is None else np.asarray(parameters, dtype=np.float64)
+        self.group_id = group_id
+        self.nfev = [None] * len(self.parameters)
+        self.build_lookup()
+
+    def bands(self):
+        bounds = [None] + self.edges + [None]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def band_of(self, temperatures):
+        temperatures = np.asarray(temperatures, dtype=np.float64)
+        return np.where(np.isnan(temperatures), -1, np.searchsorted(self.edges, temperatures, side="right"))
+
+    def build_lookup(self):
+        trained = np.flatnonzero(~np.isnan(self.parameters).any(axis=1))
+        if len(trained) == 0:
+            self.lookup = np.full(len(self.parameters), -1)
+            return
+        bands = np.arange(len(self.parameters))
+        self.lookup = trained[np.abs(bands[:, None] - trained[None, :]).argmin(axis=1)]
+
+    def fit(self, model, max_workers=None, initial_guess=None, options=None, min_days=MIN_DAYS_PER_EXPERT):
+        """
+        Train one expert per band on model.features_df, all bands in parallel on shared arrays.
+        Bands with less than min_days days of data get no expert, they are dispatched to the nearest trained band.
+        """
+        arrays = model.compile_features()
+        bands = self.band_of(arrays["all_day_temperature"])
+        days = arrays["date"] // (24 * 3600 * 10**9)
+        jobs = []
+        for band in range(len(self.parameters)):
+            positions = np.flatnonzero(bands == band)
+            if len(np.unique(days[positions])) >= min_days:
+                jobs.append((band, positions))
+        initial_guess = initial_guess if initial_guess is not None else DEFAULT_INITIAL_GUESS
+        results = optimize_shared_features(
+            arrays,
+            [initial_guess] * len(jobs),
+            max_workers=max_workers,
+            options=options,
+            positions=[positions for band, positions in jobs],
+        )
+        self.parameters = np.full((len(self.edges) + 1, 5), np.nan)
+        self.nfev = [None] * len(self.parameters)
+        for (band, positions), result in zip(jobs, results):
+            if result is not None:
+                self.parameters[band] = result["parameters"]
+                self.nfev[band] = result["nfev"]
+        self.group_id = dt.datetime.now().strftime("experts-%Y%m%d%H%M%S")
+        self.build_lookup()
+        return self
+
+    def log(self, model, log_path=RUNS_LOG_PATH):
+        """
+        Write one runs.csv row per expert, rmse and mae being computed on the expert's band.
+        Rows are tagged with model EXPERT_MODEL so that they are never taken for full range 1R1C runs.
+        """
+        bands = self.band_of(model.features_df["all_day_temperature"])
+        # build_run_log works on model.pred_df and model.optimal_parameters, restored afterwards
+        saved = {name: getattr(model, name) for name in ("pred_df", "optimal_parameters") if hasattr(model, name)}
+        try:
+            for band, (temp_min, temp_max) in enumerate(self.bands()):
+                if np.isnan(self.parameters[band]).any():
+                    continue
+                model.pred_df = model.features_df.iloc[np.flatnonzero(bands == band)]
+                model.optimal_parameters = self.parameters[band]
+                row = model.build_run_log(None, temp_min, temp_max, nfev=self.nfev[band]).assign(group_id=self.group_id, model=EXPERT_MODEL)
+                populate_database(row, log_path)
+        finally:
+            for name in ("pred_df", "optimal_parameters"):
+                if name in saved:
+                    setattr(model, name, saved[name])
+                elif hasattr(model, name):
+                    delattr(model, name)
+
+    def predict_arrays(self, arrays):
+        """
+        Vectorized prediction on compiled arrays where each row uses the expert of its band.
+        Time shifts and Tlim are gathered per row, the recurrence runs once per expert (never per day).
+        """
+        experts = np.full(len(arrays["date"]), -1)
+        bands = self.band_of(arrays["all_day_temperature"])
+        experts[bands >= 0] = self.lookup[bands[bands >= 0]]
+        T_int_pred = np.full(len(experts), np.nan)
+        for expert in np.unique(experts[experts >= 0]):
+            positions = np.flatnonzero(experts == expert)
+            T_int_pred[positions] = predict_arrays_subset(arrays, self.parameters[expert], positions)
+        return T_int_pred
+
+    def predict(self, model):
+        """Same output as TemperatureModel.predict, T_int_pred coming from each day's expert, plus the expert used."""
+        arrays = model.compile_features()
+        bands = self.band_of(arrays["all_day_temperature"])
+        return (
+            model.features_df.reset_index(drop=True)
+            .assign(
+                expert=np.where(bands >= 0, self.lookup[np.maximum(bands, 0)], -1),
+                T_int_pred=self.predict_arrays(arrays),
+            )
+        )
+
+    def custom_loss(self, arrays):
+        squared_errors = (arrays["temperature_int"] - self.predict_arrays(arrays)) ** 2
+        return np.nanmean(squared_errors * arrays["loss_weights"])
+
+    @classmethod
+    def from_logs(cls, module_name, group_id=None):
+        log_runs = prepare_logs()
+        if "group_id" not in log_runs.columns:
+            raise ValueError("No expert bank logged yet")
+        log_runs = log_runs[(log_runs["module_name"] == module_name) & log_runs["group_id"].notna()]
+        if len(log_runs.index) == 0:
+            raise ValueError(f"No expert bank logged for module {module_name}")
+        group_id = group_id or log_runs.sort_values("date")["group_id"].iloc[-1]
+        group = log_runs[log_runs["group_id"].astype(str) == str(group_id)]
+        edges = sorted(set(group["temp_min"].dropna()) | set(group["temp_max"].dropna()))
+        bank = cls(edges, group_id=str(group_id))
+        for row in group.itertuples(index=False):
+            band = 0 if pd.isna(row.temp_min) else bank.band_of([row.temp_min])[0]
+            bank.parameters[band] = row.parameters
+        bank.build_lookup()
+        return bank
+
+
+def predict_arrays_subset(arrays, parameters, positions):
+    """
+    Prediction on the rows at positions only, days of positions restarting from their first measured temperature.
+    Unlike predict_arrays(select_rows(arrays, positions), ...), the time shift of the switch is applied on the full
+    arrays, so the first rows of a day see the switch states of the previous (possibly other expert's) rows.
+    """
+    shifted = positions - int(parameters[4])
+    valid = (shifted >= 0) & (shifted < len(arrays["is_on"]))
+    is_heating = np.where(valid, arrays["is_on"][np.clip(shifted, 0, len(arrays["is_on"]) - 1)], 0)
+    return predict_arrays(select_rows(arrays, positions), parameters, is_heating=is_heating.astype(np.float64))
@@ -0,0 +1,267 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+from src.optimizer import optimize_parameters
+
+# This file compiles TemperatureModel.features_df into plain numpy arrays, the only data a loss evaluation needs.
+# The arrays can be published once in a multiprocessing.shared_memory block: worker processes attach to it
+# zero-copy instead of each receiving a pickled copy of the DataFrame.
+
+logger = logging.getLogger(__name__)
+
+TIME_STEP = 300 # seconds between two rows of features_df
+
+
+def compile_features(features_df, P_consigne):
+    """
+    Compile a features DataFrame (features_df or one of its selections) into numpy arrays.
+
+    Args:
+        features_df (pd.DataFrame): DataFrame built by TemperatureModel.build_features_df, sorted by date.
+        P_consigne (float): Consigne power value.
+
+    Returns:
+        dict: Arrays keyed by name.
+            - date: int64 epoch in ns
+            - temperature_ext, temperature_int, direct_radiation, all_day_temperature: float64
+            - is_on: uint8, 1 when the switch is on (before time shift)
+            - day_starts: int64 offsets of the first row of each day, followed by the number of rows
+            - loss_weights: float64 weights of get_custom_loss
+            - P_consigne: float64 array of size 1
+    """
+    df = features_df.reset_index(drop=True)
+    dates = pd.DatetimeIndex(df["date"]).as_unit("ns")
+    days = dates.floor("D").asi8
+    day_starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]]) if len(days) else np.array([], dtype=np.int64)
+    hours_minute = dates.hour.to_numpy() * 60 + dates.minute.to_numpy()
+    return {
+        "date": dates.asi8.copy(),
+        "temperature_ext": df["temperature_ext"].to_numpy(dtype=np.float64),
+        "temperature_int": df["temperature_int"].to_numpy(dtype=np.float64),
+        "direct_radiation": df["direct_radiation"].to_numpy(dtype=np.float64),
+        "all_day_temperature": df["all_day_temperature"].to_numpy(dtype=np.float64),
+        "is_on": (df["state"] == "on").to_numpy(dtype=np.uint8),
+        "day_starts": np.r_[day_starts, len(df)].astype(np.int64),
+        "loss_weights": (1 + hours_minute / 1435 * 5).astype(np.float64),
+        "P_consigne": np.array([P_consigne], dtype=np.float64),
+    }
+
+
+def select_rows(arrays, positions):
+    """
+    Compiled arrays of a subset of rows (e.g. the days of a temperature window), as compile_features would
+    build them from the same subset of features_df: consecutive rows of a same day form a day.
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    subset = {key: array[positions] for key, array in arrays.items() if key not in ("day_starts", "P_consigne")}
+    days = subset["date"] // (24 * 3600 * 10**9)
+    day_starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]]) if len(days) else np.array([], dtype=np.int64)
+    subset["day_starts"] = np.r_[day_starts, len(days)].astype(np.int64)
+    subset["P_consigne"] = arrays["P_consigne"]
+    return subset
+
+
+def shift_switch(is_on, time_shift):
+    """Same as df["state"].shift(int(time_shift)) followed by == "on": rows shifted in are off."""
+    shift = int(time_shift)
+    is_heating = np.zeros(len(is_on), dtype=np.float64)
+    if shift >= 0:
+        is_heating[shift:] = is_on[:len(is_on) - shift]
+    else:
+        is_heating[:shift] = is_on[-shift:]
+    return is_heating
+
+
+def predict_arrays(arrays, parameters, is_heating=None):
+    """
+    Vectorized equivalent of TemperatureModel.predict on compiled arrays, returns T_int_pred.
+    Within a day Tint follows T[i] = a * T[i-1] + (1 - a) * Tlim[i] with a = exp(-300 / (R * C)),
+    which is run by scipy's lfilter on a (days x steps) matrix. Each day starts from the measured temperature.
+    is_heating overrides the time shifted switch of arrays when given.
+    """
+    R, C, alpha, P_voisin, time_shift = parameters[:5]
+    temperature_ext = arrays["temperature_ext"]
+    if is_heating is None:
+        is_heating = shift_switch(arrays["is_on"], time_shift)
+    Tlim = temperature_ext + R * (
+        arrays["P_consigne"][0] * is_heating +
+        alpha * arrays["direct_radiation"] +
+        P_voisin * (15 - temperature_ext)
+    )
+    decay = np.exp(-TIME_STEP / (R * C))
+    inputs = (1 - decay) * Tlim
+    day_starts = arrays["day_starts"]
+    inputs[day_starts[:-1]] = arrays["temperature_int"][day_starts[:-1]]
+
+    lengths = np.diff(day_starts)
+    if len(lengths) == 0:
+        return inputs
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    cols = np.arange(len(inputs)) - np.repeat(day_starts[:-1], lengths)
+    padded = np.zeros((len(lengths), lengths.max()))
+    padded[rows, cols] = inputs
+    return lfilter([1.0], [1.0, -decay], padded, axis=1)[rows, cols]
+
+
+def predict_arrays_batch(arrays, parameters):
+    """
+    predict_arrays for K parameter sets at once, returns a (K x rows) array.
+    All sets advance together: the loop runs over the steps of the longest day only,
+    each step updating every (parameter set, day) pair in one numpy operation.
+    """
+    parameters = np.atleast_2d(np.asarray(parameters, dtype=np.float64))
+    R, C, alpha, P_voisin = (parameters[:, k:k + 1] for k in range(4))
+    n_rows = len(arrays["temperature_ext"])
+    shifts = parameters[:, 4].astype(int)
+    shifted = np.arange(n_rows)[None, :] - shifts[:, None]
+    valid = (shifted >= 0) & (shifted < n_rows)
+    is_heating = np.where(valid, arrays["is_on"][np.clip(shifted, 0, max(n_rows - 1, 0))], 0)
+    temperature_ext = arrays["temperature_ext"][None, :]
+    Tlim = temperature_ext + R * (
+        arrays["P_consigne"][0] * is_heating +
+        alpha * arrays["direct_radiation"][None, :] +
+        P_voisin * (15 - temperature_ext)
+    )
+    decay = np.exp(-TIME_STEP / (R * C))
+    inputs = (1 - decay) * Tlim
+    day_starts = arrays["day_starts"]
+    inputs[:, day_starts[:-1]] = arrays["temperature_int"][day_starts[:-1]]
+
+    lengths = np.diff(day_starts)
+    if len(lengths) == 0:
+        return inputs
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    cols = np.arange(n_rows) - np.repeat(day_starts[:-1], lengths)
+    padded = np.zeros((len(parameters), len(lengths), lengths.max()))
+    padded[:, rows, cols] = inputs
+    for step in range(1, padded.shape[2]):
+        padded[:, :, step] += decay * padded[:, :, step - 1]
+    return padded[:, rows, cols]
+
+
+def custom_loss_arrays(arrays, parameters):
+    """Same as get_custom_loss(TemperatureModel.predict(parameters)) on compiled arrays."""
+    squared_errors = (arrays["temperature_int"] - predict_arrays(arrays, parameters)) ** 2
+    return np.nanmean(squared_errors * arrays["loss_weights"])
+
+
+class SharedFeatures:
+    """
+    Compiled feature arrays published in a single shared memory block.
+
+    Attributes:
+        shm (SharedMemory): The underlying block.
+        arrays (dict): numpy views on the block, keyed like compile_features output.
+        handle (dict): Picklable description of the block, pass it to attach_shared_features in workers.
+    Methods:
+        publish(arrays): Copies arrays into a new block and returns the SharedFeatures owning it.
+        close(): Releases this process' mapping. The owner also unlinks the block.
+    """
+
+    def __init__(self, shm, handle, owner=False):
+        self.shm = shm
+        self.handle = handle
+        self.owner = owner
+        self.arrays = _views(shm, handle)
+
+    @classmethod
+    def publish(cls, arrays):
+        layout = []
+        offset = 0
+        for key, array in arrays.items():
+            offset = -(-offset // 64) * 64 # keep every array 64-byte aligned
+            layout.append((key, array.dtype.str, array.shape, offset))
+            offset += array.nbytes
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        handle = {"name": shm.name, "layout": layout}
+        shared = cls(shm, handle, owner=True)
+        for key, array in arrays.items():
+            shared.arrays[key][...] = array
+        return shared
+
+    def close(self):
+        self.arrays = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _views(shm, handle):
+    return {
+        key: np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+        for key, dtype, shape, offset in handle["layout"]
+    }
+
+
+# Blocks already attached by this worker process, so that successive jobs on the same home map it only once
+_attached = {}
+
+def attach_shared_features(handle):
+    """
+    Attach to a block published by SharedFeatures.publish and return its arrays, without copying them.
+    """
+    if handle["name"] not in _attached:
+        try:
+            # track=False: the publishing process owns the block, the worker must not unlink it at exit
+            shm = shared_memory.SharedMemory(name=handle["name"], track=False)
+        except TypeError: # python < 3.13, workers share the publisher's resource tracker anyway
+            shm = shared_memory.SharedMemory(name=handle["name"])
+        _attached[handle["name"]] = SharedFeatures(shm, handle)
+    return _attached[handle["name"]].arrays
+
+
+def fit_shared_features(handle, initial_guess, options=None, positions=None):
+    """
+    Worker: run one optimization on shared arrays, restricted to the rows at positions when given,
+    and return the successful result dict, or None.
+    """
+    arrays = attach_shared_features(handle)
+    if positions is not None:
+        arrays = select_rows(arrays, positions)
+    results = optimize_parameters(
+        loss_function=lambda parameters: custom_loss_arrays(arrays, parameters),
+        initial_guess=initial_guess,
+        options=options,
+        log=logger.debug,
+    )
+    for method, result in results.items():
+        if isinstance(result, dict) and result["success"]:
+            return result
+    return None
+
+
+def optimize_shared_features(arrays, initial_guesses, max_workers=None, options=None, positions=None):
+    """
+    Run one optimization per initial guess on a process pool. The arrays are published once in shared
+    memory and every worker attaches to the same copy.
+
+    Args:
+        arrays (dict): Output of compile_features.
+        initial_guesses (list): One initial parameter list per optimization.
+        max_workers (int): Size of the process pool, defaults to the number of cores.
+        options (dict): Solver options forwarded to optimize_parameters.
+        positions (list): Row positions each optimization is restricted to (None for all rows), one per initial guess.
+
+    Returns:
+        list: One result dict (or None when the fit failed) per initial guess, in the same order.
+    """
+    max_workers = min(max_workers or os.cpu_count() or 1, max(len(initial_guesses), 1))
+    positions = positions or [None] * len(initial_guesses)
+    with SharedFeatures.publish(arrays) as shared, ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(fit_shared_features, shared.handle, initial_guess, options, job_positions)
+            for initial_guess, job_positions in zip(initial_guesses, positions)
+        ]
+        return [future.result() for future in futures]
@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.data_loader import load_entity_data
+
+# This file maintains the energy KPIs of each module as small pre-aggregated tables, so that dashboards and
+# comparisons across homes do not resample the raw histories on every view.
+# The base table has one row per UTC hour, stored in data/<db_name>/kpis/hourly.csv:
+# - uptime_h: hours the heater was on, integrated between the switch transitions (a state holds until the next one)
+# - kwh: uptime_h * P_consigne / 1000, as Simulation.compute_scenarios_consumption
+# - hdd: heating degree-days, max(0, HDD_BASE - temperature_2m) integrated over the hour (hourly weather)
+# - temperature_ext: mean outside temperature
+# - temperature_int_degree_hours / temperature_int_hours: integral of the indoor temperature (readings held until
+#   the next one) and the time it covers, so that any coarser mean is their ratio
+# Only complete hours (up to the newest switch or temperature_int row) are stored. update_rollups recomputes the last
+# REFRESH_HOURS stored hours, for data arriving late, and the new ones: update_db calls it after each ingestion.
+# Daily and monthly tables are rolled up from the hourly one by rollup_kpis.
+# Refresh from the command line: python -m src.kpis [modules]
+
+HDD_BASE = 18.0 # °C, base temperature of French degree-days (DJU)
+REFRESH_HOURS = 24
+HOUR = 3600 * 10**9 # ns
+SUM_COLUMNS = ["uptime_h", "kwh", "hdd", "temperature_int_degree_hours", "temperature_int_hours"]
+
+
+def rollups_path(module_config):
+    return f"data/{module_config["db_name"]}/kpis/hourly.csv"
+
+
+def step_integral(dates, values, edges, end):
+    """
+    Integral in hours of a step function (values[i] from dates[i] until dates[i + 1], the last one until end),
+    from dates[0] to each edge, and the hours it covers up to each edge. Both are 0 before dates[0].
+    """
+    edges = np.minimum(edges, end)
+    if len(dates) == 0:
+        return np.zeros(len(edges)), np.zeros(len(edges))
+    cumulated = np.r_[0, np.cumsum(values[:-1] * np.diff(dates))]
+    last = np.searchsorted(dates, edges, side="right") - 1
+    before = last < 0
+    last = np.maximum(last, 0)
+    integral = np.where(before, 0, cumulated[last] + values[last] * (edges - dates[last])) / HOUR
+    covered = np.maximum(edges - dates[0], 0) / HOUR
+    return integral, covered
+
+
+def entity_steps(df, column, start=None):
+    """Sorted int64 dates and float values of an entity, keeping only the last row before start (its value holds)."""
+    df = df.assign(date=lambda df: pd.to_datetime(df["date"], utc=True, format="ISO8601")).dropna(subset=[column]).sort_values("date")
+    dates = pd.DatetimeIndex(df["date"]).as_unit("ns").asi8
+    values = df[column].to_numpy(dtype=np.float64)
+    if start is not None:
+        first = max(np.searchsorted(dates, start, side="right") - 1, 0)
+        dates, values = dates[first:], values[first:]
+    return dates, values
+
+
+def hourly_kpis(module_config, start=None, switch_df=None, temperature_int_df=None, weather_df=None):
+    """
+    Hourly KPI rows of a module from start (epoch ns, aligned on an hour) to its newest complete hour.
+
+    Args:
+        module_config (dict): Configuration dictionary containing module-specific settings, defined in config.json.
+        start (int): First hour to compute, the first hour of data by default.
+        switch_df, temperature_int_df, weather_df (pd.DataFrame): Stored entities, loaded when not given.
+
+    Returns:
+        pd.DataFrame: One row per hour with hour (UTC) and the columns described in the header of this file.
+    """
+    start_date = None if start is None else pd.Timestamp(start, tz="UTC")
+    switch_df = load_entity_data(module_config, "switch", start_date) if switch_df is None else switch_df
+    temperature_int_df = load_entity_data(module_config, "temperature_int", start_date) if temperature_int_df is None else temperature_int_df
+    weather_df = load_entity_data(module_config, "weather", start_date) if weather_df is None else weather_df
+
+    switch_dates, switch_on = entity_steps(switch_df.assign(on=lambda df: (df["state"] == "on").astype(float)), "on", start)
+    temperature_dates, temperature_int = entity_steps(
+        temperature_int_df.assign(temperature=lambda df: pd.to_numeric(df["temperature"], errors="coerce")), "temperature", start,
+    )
+    weather_dates, temperature_ext = entity_steps(weather_df, "temperature_2m", start)
+
+    # Data is known up to the newest switch or temperature reading, weather rows beyond are forecasts
+    known = [dates[-1] for dates in (switch_dates, temperature_dates) if len(dates)]
+    firsts = [dates[0] for dates in (switch_dates, temperature_dates) if len(dates)]
+    if not known:
+        return pd.DataFrame(columns=["hour"] + SUM_COLUMNS + ["temperature_ext"])
+    end = max(known)
+    first_hour = min(firsts) // HOUR * HOUR if start is None else start
+    edges = np.arange(first_hour, end // HOUR * HOUR + 1, HOUR, dtype=np.int64)
+    if len(edges) < 2:
+        return pd.DataFrame(columns=["hour"] + SUM_COLUMNS + ["temperature_ext"])
+
+    per_hour = lambda integral: np.diff(integral)
+    uptime, _ = step_integral(switch_dates, switch_on, edges, end)
+    degree_hours, temperature_hours = step_integral(temperature_dates, temperature_int, edges, end)
+    hdd_hours, _ = step_integral(weather_dates, np.maximum(HDD_BASE - temperature_ext, 0), edges, end)
+    ext_degree_hours, ext_hours = step_integral(weather_dates, temperature_ext, edges, end)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        temperature_ext_mean = per_hour(ext_degree_hours) / per_hour(ext_hours)
+    return pd.DataFrame({
+        "hour": pd.to_datetime(edges[:-1], utc=True),
+        "uptime_h": per_hour(uptime),
+        "kwh": per_hour(uptime) * module_config["P_consigne"] / 1000,
+        "hdd": per_hour(hdd_hours) / 24,
+        "temperature_int_degree_hours": per_hour(degree_hours),
+        "temperature_int_hours": per_hour(temperature_hours),
+        "temperature_ext": temperature_ext_mean,
+    })
+
+
+def read_rollups(module_config):
+    """Stored hourly KPIs of a module, empty when they were never computed."""
+    path = rollups_path(module_config)
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=["hour"] + SUM_COLUMNS + ["temperature_ext"])
+    return pd.read_csv(path, sep=",").assign(hour=lambda df: pd.to_datetime(df["hour"], utc=True))
+
+
+def update_rollups(module_config):
+    """
+    Bring the stored hourly KPIs of a module up to date: the last REFRESH_HOURS stored hours and the new ones are
+    recomputed, older hours are kept as they are.
+
+    Returns:
+        pd.DataFrame: The whole hourly table.
+    """
+    hourly = read_rollups(module_config)
+    start = None
+    if len(hourly.index):
+        start = max(hourly["hour"].iloc[-1].value - (REFRESH_HOURS - 1) * HOUR, hourly["hour"].iloc[0].value)
+        hourly = hourly[hourly["hour"] < pd.Timestamp(start, tz="UTC")]
+    new_hours = hourly_kpis(module_config, start)
+    if len(new_hours.index):
+        hourly = pd.concat([df for df in (hourly, new_hours) if len(df.index)], ignore_index=True)
+    path = rollups_path(module_config)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    hourly.to_csv(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+    return hourly
+
+
+def rollup_kpis(hourly, freq="D"):
+    """
+    Roll hourly KPIs up to a coarser period.
+
+    Args:
+        hourly (pd.DataFrame): Output of read_rollups or hourly_kpis.
+        freq (str): pandas frequency, "h", "D" or "MS" (months).
+
+    Returns:
+        pd.DataFrame: Indexed by period start, with the summed columns, the mean temperatures and kwh_per_hdd
+            (heating energy per degree-day, comparable across homes and seasons).
+    """
+    if len(hourly.index) == 0:
+        return pd.DataFrame(columns=SUM_COLUMNS + ["temperature_ext", "temperature_int", "kwh_per_hdd"]).rename_axis("period")
+    hourly = hourly.set_index("hour")
+    if freq == "MS":
+        # Calendar months of UTC hours, without the ambiguity of resampling a tz-aware index by month
+        periods = hourly.index.tz_convert(None).to_period("M").to_timestamp().tz_localize("UTC")
+        rolled = hourly[SUM_COLUMNS].groupby(periods).sum().assign(temperature_ext=hourly["temperature_ext"].groupby(periods).mean())
+    else:
+        rolled = hourly[SUM_COLUMNS].resample(freq).sum().assign(temperature_ext=hourly["temperature_ext"].resample(freq).mean())
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return rolled.assign(
+            temperature_int=rolled["temperature_int_degree_hours"] / rolled["temperature_int_hours"].where(rolled["temperature_int_hours"] > 0),
+            kwh_per_hdd=rolled["kwh"] / rolled["hdd"].where(rolled["hdd"] > 0),
+        ).rename_axis("period")
+
+
+def compare_modules(module_configs, freq="MS"):
+    """Stored KPIs of several modules rolled up to freq, one row per (module_name, period)."""
+    return pd.concat(
+        [rollup_kpis(read_rollups(module_config), freq).assign(module_name=module_config["module_name"]) for module_config in module_configs],
+    ).reset_index().set_index(["module_name", "period"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Update the hourly KPI rollups of modules and print their monthly KPIs.")
+    parser.add_argument("modules", nargs="*", help="Modules to update, all modules of the config by default")
+    parser.add_argument("--config", default="config.json")
+    parser.add_argument("--freq", default="MS", help="Period of the printed KPIs: h, D or MS (months)")
+    args = parser.parse_args()
+
+    config = json.load(open(args.config, "r"))
+    module_configs = [config[module_name] for module_name in args.modules or config.keys()]
+    for module_config in module_configs:
+        try:
+            update_rollups(module_config)
+        except FileNotFoundError as e:
+            print(f"{module_config['module_name']}: no data ({e})")
+    with pd.option_context("display.width", 200, "display.max_columns", None, "display.float_format", "{:.2f}".format):
+        print(compare_modules(module_configs, args.freq)[["uptime_h", "kwh", "hdd", "kwh_per_hdd", "temperature_int", "temperature_ext"]])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.data_loader import get_data_version
+from src.features import predict_arrays_batch
+from src.model import MODEL_FAMILIES, ONE_NODE, TemperatureModel
+from src.utils import prepare_logs
+
+# This file scores every run of runs.csv against the latest data of its module, instead of re-evaluating
+# runs one at a time from the pages. All runs of a module are predicted in one batched pass, and scores are
+# cached in data/logs/scores.csv by data version: a run is only re-scored when the module's data changed.
+# Runs of every model family are scored, 1R1C ones in a single batch. Band expert runs (see src/experts.py) are
+# left out: fitted on one all_day_temperature band, they would be ranked against global fits on all the data.
+
+logger = logging.getLogger(__name__)
+
+SCORES_PATH = "data/logs/scores.csv"
+# Same columns as build_residuals in page 02
+RESIDUAL_CORRELATION_COLUMNS = ["date", "hours_minute", "temperature_ext", "all_day_temperature", "shape_t_ext", "is_heating"]
+
+
+def score_parameters(arrays, parameters, T_int_pred=None):
+    """
+    Score K parameter sets on compiled arrays in one pass.
+
+    Args:
+        arrays (dict): Output of compile_features.
+        parameters (array-like): (K x 5) parameter sets, single node view (to_one_node) for other model families.
+        T_int_pred (np.ndarray): (K x rows) predictions of the parameter sets, predict_arrays_batch when not given.
+
+    Returns:
+        pd.DataFrame: One row per parameter set with rmse, mae, custom_loss and the correlation of the
+        residuals with each of RESIDUAL_CORRELATION_COLUMNS (corr_<column>).
+    """
+    parameters = np.atleast_2d(np.asarray(parameters, dtype=np.float64))
+    if T_int_pred is None:
+        T_int_pred = predict_arrays_batch(arrays, parameters)
+    residuals = arrays["temperature_int"][None, :] - T_int_pred
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scores = {
+            "rmse": np.sqrt(np.nanmean(residuals ** 2, axis=1)),
+            "mae": np.nanmean(np.abs(residuals), axis=1),
+            "custom_loss": np.nanmean(residuals ** 2 * arrays["loss_weights"][None, :], axis=1),
+        }
+        dates = pd.to_datetime(arrays["date"], utc=True)
+        n_rows = len(arrays["date"])
+        shifted = np.arange(n_rows)[None, :] - parameters[:, 4].astype(int)[:, None]
+        is_heating = np.where((shifted >= 0) & (shifted < n_rows), arrays["is_on"][np.clip(shifted, 0, max(n_rows - 1, 0))], 0)
+        columns = {
+            "date": arrays["date"].astype(np.float64),
+            "hours_minute": (dates.hour * 100 + dates.minute).to_numpy(dtype=np.float64),
+            "temperature_ext": arrays["temperature_ext"],
+            "all_day_temperature": arrays["all_day_temperature"],
+            "shape_t_ext": 15 - arrays["temperature_ext"],
+            "is_heating": is_heating.astype(np.float64),
+        }
+        for name in RESIDUAL_CORRELATION_COLUMNS:
+            scores[f"corr_{name}"] = pairwise_correlation(residuals, np.broadcast_to(columns[name], residuals.shape))
+    return pd.DataFrame(scores)
+
+
+def pairwise_correlation(x, y):
+    """Row-wise Pearson correlation ignoring NaN pairs, as DataFrame.corr does."""
+    mask = ~(np.isnan(x) | np.isnan(y))
+    count = mask.sum(axis=1)
+    x = np.where(mask, x, 0)
+    y = np.where(mask, y, 0)
+    x_centered = np.where(mask, x - (x.sum(axis=1) / count)[:, None], 0)
+    y_centered = np.where(mask, y - (y.sum(axis=1) / count)[:, None], 0)
+    covariance = (x_centered * y_centered).sum(axis=1)
+    return covariance / np.sqrt((x_centered ** 2).sum(axis=1) * (y_centered ** 2).sum(axis=1))
+
+
+def score_runs(arrays, runs):
+    """score_parameters of runs.csv rows (from prepare_logs) of any model family, in the order of runs."""
+    parameters = np.array(runs["parameters"].tolist(), dtype=np.float64)
+    one_node = (runs["model"] == ONE_NODE.name).to_numpy()
+    T_int_pred = np.empty((len(runs.index), len(arrays["date"])))
+    if one_node.any():
+        T_int_pred[one_node] = predict_arrays_batch(arrays, parameters[one_node])
+    for position in np.flatnonzero(~one_node):
+        run = runs.iloc[position]
+        family = MODEL_FAMILIES[run["model"]]
+        T_int_pred[position] = family.predict_arrays(arrays, run[family.parameter_names].astype(float).tolist())
+    return score_parameters(arrays, parameters, T_int_pred)
+
+
+def build_leaderboard(config, module_names=None, scores_path=SCORES_PATH):
+    """
+    Score every logged run against the latest data of its module, reusing cached scores of the same data version.
+
+    Args:
+        config (dict): Content of config.json.
+        module_names (list): Modules to score, all modules of runs.csv found in config by default.
+        scores_path (str): Cache file.
+
+    Returns:
+        pd.DataFrame: runs.csv rows (date, module_name, parameters...) with their scores, best rmse first per module.
+    """
+    log_runs = prepare_logs().loc[lambda df: df["model"].isin(MODEL_FAMILIES)]
+    cache = pd.read_csv(scores_path, sep=",", parse_dates=["date"]) if os.path.exists(scores_path) else pd.DataFrame()
+    module_names = module_names or [module_name for module_name in log_runs["module_name"].unique() if module_name in config]
+    leaderboard = []
+    new_scores = []
+    data_versions = {}
+    for module_name in module_names:
+        module_config = config[module_name]
+        runs = log_runs[log_runs["module_name"] == module_name]
+        data_version = data_versions[module_name] = get_data_version(module_config)
+        cached = pd.DataFrame()
+        if len(cache.index):
+            cached = cache[(cache["module_name"] == module_name) & (cache["data_version"] == data_version) & cache["date"].isin(runs["date"])]
+        missing = runs[~runs["date"].isin(cached["date"])] if len(cached.index) else runs
+        if len(missing.index):
+            try:
+                arrays = TemperatureModel(module_config).compile_features()
+            except Exception as e:
+                logger.warning(f"Cannot score {module_name}: {e}")
+                continue
+            scores = score_runs(arrays, missing).assign(
+                date=missing["date"].to_numpy(),
+                module_name=module_name,
+                data_version=data_version,
+            )
+            new_scores.append(scores)
+            cached = pd.concat([cached, scores], ignore_index=True)
+        leaderboard.append(
+            runs.drop(columns=["rmse", "mae"], errors="ignore")
+            .merge(cached.drop(columns=["module_name"]), on="date", how="left")
+            .sort_values("rmse")
+        )
+    if new_scores:
+        if len(cache.index):
+            # Scores of a previous data version will never be read again
+            stale = cache["module_name"].map(data_versions).notna() & (cache["module_name"].map(data_versions) != cache["data_version"])
+            new_scores = [cache[~stale]] + new_scores
+        pd.concat(new_scores, ignore_index=True).to_csv(scores_path, index=False)
+    if not leaderboard:
+        return pd.DataFrame()
+    return pd.concat(leaderboard, ignore_index=True)
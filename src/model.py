@@ -1,11 +1,25 @@
 import numpy as np
 import pandas as pd
-import streamlit as st
 import datetime as dt
-from src.data_loader import populate_database
+from src.data_loader import populate_database, load_entity_data, to_utc_timestamp
 from src.data_processing import prepare_switch_df, prepare_temperature_df, prepare_weather_df
-import plotly.graph_objects as go
 from src.optimizer import optimize_parameters
+from scipy.linalg import expm
+from scipy.signal import lfilter
+from src.features import TIME_STEP, compile_features, predict_arrays, shift_switch
+from src.events import EventEngine
+from src.multifidelity import fit_coarse, scan_time_shift
+from src.uncertainty import estimate_uncertainty, CHI2_95, PARAMETER_NAMES
+from src.utils import get_latest_parameters
+from src.tracing import current_span, module_tags, traced
+from src.ui import st, streamlit_running
+
+DEFAULT_INITIAL_GUESS = [1e-2, 4.3e6, 87, 65.5, 2] # R, C, alpha, Pvoisin, time_shift switch / T
+RUNS_LOG_PATH = "data/logs/runs.csv"
+
+
+def model_tags(model, *args, **kwargs):
+    return module_tags(model.module_config)
 
 
 class TemperatureModel:
@@ -19,6 +33,7 @@ class TemperatureModel:
         temperature_int_df (pd.DataFrame): input DataFrame containing internal temperature data.
         switch_df (pd.DataFrame): input DataFrame containing switch data.
         weather_df (pd.DataFrame): input DataFrame containing weather data.
+        start (pd.Timestamp): First date of features_df when only recent data is needed, None for all data.
     Methods:
         load_data(): Loads input data from CSV files into DataFrames before further processing.
         preprocess_data(): Preprocesses the input data by cleaning and transforming it into a suitable format.
@@ -26,32 +41,56 @@ class TemperatureModel:
         predict(): Predicts the internal temperature based on the features DataFrame. Whithout a doubt, the most important method of the class.
     """
 
-    def __init__(self, module_config):
+    @traced("TemperatureModel", tags=lambda model, module_config, *args, **kwargs: module_tags(module_config))
+    def __init__(self, module_config, start=None):
         self.features_df = None
+        self.model_family = "1R1C"
         self.P_consigne = module_config["P_consigne"]
         self.module_config = module_config
+        self.start = None if start is None else to_utc_timestamp(start)
         self.load_data()
         self.preprocess_data()
         self.build_features_df()
 
+    @traced(tags=model_tags)
     def load_data(self):
+        # One day of margin before start for the resampling, interpolation and rolling windows of preprocess_data
+        margin_start = None if self.start is None else self.start.floor("D") - dt.timedelta(days=1)
         for k, v in self.module_config["entities"].items():
-            setattr(self, f"{k}_df", pd.read_csv(f"data/{self.module_config["db_name"]}/{k}.csv", sep=","))
-        self.weather_df = pd.read_csv(f"data/{self.module_config["db_name"]}/weather.csv", sep=",")
+            setattr(self, f"{k}_df", load_entity_data(self.module_config, k, start=margin_start))
+        self.weather_df = load_entity_data(self.module_config, "weather", start=margin_start)
 
+    @traced(tags=model_tags)
     def preprocess_data(self):
         self.temperature_int_df = prepare_temperature_df(self.temperature_int_df)
         self.switch_df = prepare_switch_df(self.switch_df)
         self.weather_df = prepare_weather_df(self.weather_df)
 
+    @traced(tags=model_tags)
     def build_features_df(self):
         self.features_df = (
             self.weather_df.copy()
             .merge(self.temperature_int_df, on='date', how='right', suffixes=["_ext", "_int"])
             .merge(self.switch_df, on='date', how='outer')
             .loc[:, ['date', 'temperature_ext', 'all_day_temperature', 'roll5_avg_temperature', 'temperature_int', 'state', 'direct_radiation']]
-            .loc[lambda x: x["date"]> '2025-01-04']
+            .pipe(index_features_df)
+            .pipe(self.select_timeframe, ['2025-01-04', None])
         )
+        if self.start is not None:
+            self.features_df = self.features_df.iloc[self.features_df.index.searchsorted(self.start):]
+        self.temperature_index = TemperatureWindowIndex(self.features_df)
+        current_span().set(rows=len(self.features_df.index))
+
+    def predict_logged_run(self, run):
+        """Prediction of a runs.csv row (from prepare_logs) with its own model family."""
+        family = MODEL_FAMILIES.get(run["model"], ONE_NODE) # expert rows are single node runs on a temperature band
+        if family is ONE_NODE:
+            return self.predict(run["parameters"])
+        return family.predict_df(self, run[family.parameter_names].tolist())
+
+    def compile_features(self, df=None):
+        """Compile df (features_df by default) into the numpy arrays used by src.features."""
+        return compile_features(self.features_df if df is None else df, self.P_consigne)
 
     def cost_function_wrapped_RMSE(self, parameters):
         pred_df = self.predict(parameters)
@@ -65,6 +104,7 @@ class TemperatureModel:
         pred_df = self.predict(parameters)
         return get_custom_loss(pred_df)
 
+    @traced(tags=model_tags, skip_within="fit")
     def predict(self, parameters):
         """
         This function builds the predicted Tint(t) for a given set of parameter
@@ -111,34 +151,100 @@ class TemperatureModel:
 
     @staticmethod
     def select_timeframe(df, predict_timeframe):
-        return (
-            df.copy()
-            .loc[lambda x: x["date"] > predict_timeframe[0]]
-            .loc[lambda x: x["date"] < predict_timeframe[1]]
-        )
+        """
+        Select the rows of df strictly between predict_timeframe[0] and predict_timeframe[1] (None for no bound).
+        predict_timeframe can also be a list of such [start, end] windows, their union is returned.
+        df must be sorted on date: bounds are found by binary search and a single window is returned as a slice.
+        """
+        if isinstance(predict_timeframe[0], (list, tuple)):
+            timeframes = predict_timeframe
+        else:
+            timeframes = [predict_timeframe]
+        index = date_index(df)
+        bounds = [
+            (
+                0 if start is None else index.searchsorted(to_index_timestamp(index, start), side="right"),
+                len(index) if end is None else index.searchsorted(to_index_timestamp(index, end), side="left"),
+            )
+            for start, end in timeframes
+        ]
+        if len(bounds) == 1:
+            return df.iloc[bounds[0][0]:bounds[0][1]]
+        return df.iloc[np.unique(ranges_positions(*np.array(bounds).reshape(-1, 2).T))]
+
+    @staticmethod
+    def select_last_days(df, n_days):
+        """Keep only the newest n_days of df, counted back from its last date."""
+        index = date_index(df)
+        return df.iloc[index.searchsorted(index[-1] - dt.timedelta(days=n_days), side="right"):]
     
-    def log_run(self, train_timeframe, temp_min, temp_max):
+    @traced(tags=model_tags)
+    def log_run(self, train_timeframe, temp_min, temp_max, nfev=None, uncertainty=None):
+        populate_database(self.build_run_log(train_timeframe, temp_min, temp_max, nfev, uncertainty), RUNS_LOG_PATH)
+
+    def build_run_log(self, train_timeframe, temp_min, temp_max, nfev=None, uncertainty=None):
+        """
+        Build the runs.csv row for self.optimal_parameters, without writing it.
+        With an estimate_uncertainty report, the row also gets the std of each parameter and the R-C correlation.
+        """
         date = dt.datetime.now()
         params = self.optimal_parameters
-        pred_df = self.predict(params)
+        family = MODEL_FAMILIES[self.model_family]
+        # predict_df runs predict_arrays on compiled features: same rmse and mae as predict, without its per-row loop
+        pred_df = family.predict_df(self, params)
         module_name = self.module_config["module_name"]
-        row = [date, module_name, train_timeframe] + list(params)
+        row = [date, module_name, train_timeframe] + list(family.to_one_node(params))
         df = pd.DataFrame([row], columns=["date", "module_name", "train_timeframe", "R", "C", "alpha", "Pvoisin", "time_shift"])
+        if family is not ONE_NODE:
+            df = df.assign(model=family.name, **dict(zip(family.parameter_names, params)))
         df = df.assign(
             rmse=get_rmse(pred_df),
             mae=get_mae(pred_df),
             temp_min=temp_min,
             temp_max=temp_max,
+            nfev=nfev,
         )
-        populate_database(df, "data/logs/runs.csv")
+        if uncertainty is not None:
+            df = df.assign(
+                **{f"{name}_std": std for name, std in zip(PARAMETER_NAMES, uncertainty["summary"]["std"])},
+                corr_R_C=uncertainty["corr_R_C"],
+            )
+        return df
+
+    def get_initial_guess(self, warm_start=False, model_family="1R1C"):
+        """
+        Return (initial_guess, options) for optimize_parameters.
+        A warm start seeds from the module's most recent logged run of the model family, falling back to the
+        family's default initial guess (options is then None) when there is none.
+        """
+        family = MODEL_FAMILIES[model_family]
+        if warm_start:
+            latest_parameters = get_latest_parameters(self.module_config["module_name"], model=family.name, columns=family.parameter_names)
+            if latest_parameters is not None:
+                return latest_parameters, get_warm_start_options(latest_parameters)
+        return family.default_initial_guess, None
 
-    def get_optimal_parameters(self, train_timeframe=None, temp_min=None, temp_max=None):
-        initial_guess = [1e-2, 4.3e6, 87, 65.5, 2] # R, C, alpha, Pvoisin, time_shift switch / T
+    @traced("fit", tags=model_tags)
+    def get_optimal_parameters(self, train_timeframe=None, temp_min=None, temp_max=None, warm_start=False, last_n_days=None, model_family="1R1C", coarse_factor=None, event_driven=False):
+        """
+        Fit the model parameters on the selected data.
+        if warm_start is True, the optimizer starts from the module's most recent logged run instead of DEFAULT_INITIAL_GUESS.
+        if last_n_days is given, only the newest last_n_days of the selected data are used (typical refit setting).
+        model_family is a key of MODEL_FAMILIES, the single node RC model by default.
+        if coarse_factor is given (1R1C only), a first fit runs on blocks of coarse_factor rows (see src/multifidelity.py)
+        and the full resolution fit refines from its optimum.
+        if event_driven is True (1R1C on a date range, without coarse stage), the loss runs on the raw sensor readings
+        with EventEngine (see src/events.py) instead of the 5-minute grid. The logged rmse and mae stay grid ones.
+        """
+        family = MODEL_FAMILIES[model_family]
+        initial_guess, options = self.get_initial_guess(warm_start, model_family)
+        if warm_start and options is None:
+            st.warning("No logged run for this module, starting from default initial guess")
 
         if train_timeframe:
             self.pred_df = self.select_timeframe(self.features_df, train_timeframe)
         elif (temp_min or temp_max):
-            self.pred_df = select_features_from_temperature_window(self.features_df, temp_min, temp_max)
+            self.pred_df = select_features_from_temperature_window(self.features_df, temp_min, temp_max, temperature_index=self.temperature_index)
             if len(self.pred_df.index) == 0:
                 self.pred_df = self.features_df
                 st.warning("No data in temperature window, using all data")
@@ -146,16 +252,39 @@ class TemperatureModel:
                 temp_min = None
         else:
             self.pred_df = self.features_df
+        if last_n_days:
+            self.pred_df = self.select_last_days(self.pred_df, last_n_days)
             
-        # opti_func = self.cost_function_wrapped_MAE
-        opti_func = self.cost_function_wrapped_custom
+        # The loss of every stage runs on arrays compiled once (predict_arrays), not on the pred_df DataFrame
+        # as cost_function_wrapped_custom does at every evaluation
+        arrays = self.compile_features(self.pred_df)
+        opti_func = lambda parameters: family.custom_loss(arrays, parameters)
+        if event_driven and (family is not ONE_NODE or coarse_factor or (not train_timeframe and (temp_min or temp_max))):
+            st.warning("The event-driven engine only fits the 1R1C model at full resolution on a date range, using the 5-minute grid")
+        elif event_driven and len(self.pred_df.index):
+            dates = date_index(self.pred_df)
+            engine = EventEngine.from_module(self.module_config, [dates[0], dates[-1] + dt.timedelta(seconds=TIME_STEP)])
+            opti_func = engine.custom_loss
+        coarse_nfev = 0 # loss evaluations of the coarse stage and of the time shift scan, logged with the fine ones
+        if coarse_factor and family is not ONE_NODE:
+            st.warning("Coarse-to-fine fitting is only available for the 1R1C model, fitting at full resolution")
+        elif coarse_factor:
+            coarse = fit_coarse(arrays, initial_guess, coarse_factor, options)
+            if coarse is not None:
+                st.markdown(f"Coarse stage (x{coarse_factor}): {coarse['nfev']} loss evaluations in {coarse['seconds']:.2f} s")
+                initial_guess, _, scan_nfev = scan_time_shift(opti_func, coarse["parameters"], radius=coarse_factor)
+                coarse_nfev = coarse["nfev"] + scan_nfev
+                options = get_warm_start_options(initial_guess)
 
         results = optimize_parameters(
             loss_function=opti_func,
             initial_guess=initial_guess,
+            options=options,
         )
         # Store the optimal parameters
         self.optimal_parameters = None
+        self.uncertainty = None
+        self.model_family = family.name
         # Display results
         st.header('Optimization Results')
         for method, result in results.items():
@@ -163,8 +292,35 @@ class TemperatureModel:
                 st.subheader(method)
                 st.markdown(f"Parameters: {result['parameters']}")
                 st.markdown(f"RMSE: {result['rmse']:.6f}")
+                st.markdown(f"Loss evaluations: {result['nfev'] + coarse_nfev}")
                 self.optimal_parameters = result['parameters']
-                self.log_run(train_timeframe, temp_min, temp_max)
+                if family is ONE_NODE:
+                    self.uncertainty = estimate_uncertainty(arrays, self.optimal_parameters)
+                    self.display_uncertainty()
+                self.log_run(train_timeframe, temp_min, temp_max, nfev=result['nfev'] + coarse_nfev, uncertainty=self.uncertainty)
+
+    def display_uncertainty(self):
+        """Show the uncertainty report of the last fit: standard deviations, correlations and profile curves."""
+        if not streamlit_running():
+            return
+        import plotly.graph_objects as go
+
+        st.subheader("Parameter uncertainty")
+        st.dataframe(self.uncertainty["summary"])
+        st.markdown(
+            f"R-C correlation: {self.uncertainty['corr_R_C']:.3f}, "
+            f"Hessian condition number: {self.uncertainty['condition_number']:.1e}, "
+            f"effective samples: {self.uncertainty['n_eff']:.0f}"
+        )
+        st.dataframe(self.uncertainty["correlation"])
+        profiles = self.uncertainty["profiles"]
+        cols = st.columns(len(PARAMETER_NAMES))
+        for col, name in zip(cols, PARAMETER_NAMES):
+            profile = profiles[profiles["parameter"] == name]
+            fig = go.Figure(go.Scatter(x=profile["value"], y=profile["delta_chi2"], mode="lines+markers", name=name))
+            fig.add_hline(y=CHI2_95, line_dash="dash")
+            fig.update_layout(title=f"Profile of {name}", xaxis_title=name, yaxis_title="Δχ²", showlegend=False)
+            col.plotly_chart(fig)
 
     def test_model(self, test_timeframe=None, test_parameters=None, use_optimal_parameters=False):
         """"
@@ -186,18 +342,21 @@ class TemperatureModel:
         rmse = self.cost_function_wrapped(test_parameters)
         return test_df, rmse
     
-    def plot_paintings(self, parameters):
+    def plot_paintings(self, parameters, x_range=None):
         """
         Plot Tlim contributions as a stacked area chart showing how:
         Tlim = T_ext + T_heating + T_radiation + T_voisin
+        Contributions are averaged per hour (or longer buckets on long ranges) over x_range, the last 10 days by default.
         """
-        today = dt.date.today().strftime("%Y-%m-%d")
-        lower_bound = (dt.datetime.strptime(today, "%Y-%m-%d") - dt.timedelta(days=10)).strftime("%Y-%m-%d")
-        plot_timeframe = [str(lower_bound), str(today)]
+        import plotly.graph_objects as go # loaded on first plot only, headless runs never need it
+        from src.plotting import bar_traces
+
+        if x_range is None:
+            today = dt.date.today().strftime("%Y-%m-%d")
+            lower_bound = (dt.datetime.strptime(today, "%Y-%m-%d") - dt.timedelta(days=10)).strftime("%Y-%m-%d")
+            x_range = [str(lower_bound), str(today)]
         df = (
-            self.features_df.copy()
-            .loc[lambda x: x["date"] > plot_timeframe[0]]
-            .loc[lambda x: x["date"] < plot_timeframe[1]]
+            self.features_df
             .assign(
                 state=lambda df: df["state"].shift(int(parameters[4])),
                 shape_t_ext=lambda df: 15-df["temperature_ext"],
@@ -208,17 +367,8 @@ class TemperatureModel:
                 T_lim=lambda df: df["temperature_ext"] + df["T_heating"] + df["T_radiation"] + df["T_voisin"],
             )
         )
-        fig = go.Figure()
-
         # Add each contribution as a separate bar in the bar chart
-        for contribution in ['temperature_ext', 'T_voisin', 'T_radiation', 'T_heating']:
-            fig.add_trace(
-                go.Bar(
-                    x=df['date'],
-                    y=df[contribution],
-                    name=contribution
-                )
-            )
+        fig = go.Figure(bar_traces(df, ['temperature_ext', 'T_voisin', 'T_radiation', 'T_heating'], x_range=x_range))
 
         fig.update_layout(
             title='Temperature Limit Contributions',
@@ -234,6 +384,136 @@ class TemperatureModel:
 def compute_temperature_int(t, T0, Tlim, R, C):
     return Tlim + (T0 - Tlim) * np.exp(-t / (R * C))
 
+def get_warm_start_options(initial_guess):
+    """
+    Powell options for a refit starting close to the optimum.
+    Search directions are scaled to 10% of each parameter (R and C differ by 9 orders of magnitude,
+    so unit directions waste most evaluations) and tolerances are relaxed accordingly.
+    """
+    scale = np.abs(np.asarray(initial_guess, dtype=float)) * 0.1
+    scale[scale == 0] = 1
+    return {"direc": np.diag(scale), "xtol": 1e-2, "ftol": 1e-3}
+
+class OneNodeModel:
+    """
+    The single node RC model of the README: Tint relaxes towards Tlim with the time constant R * C.
+
+    Attributes:
+        name (str): Key in MODEL_FAMILIES and value of the model column of runs.csv.
+        parameter_names (list): Names of the parameters, also their runs.csv columns.
+        default_initial_guess (list): Starting point of the optimizer.
+    Methods:
+        predict_arrays(arrays, parameters): Predicted temperature_int on compiled arrays.
+        custom_loss(arrays, parameters): get_custom_loss on compiled arrays.
+        predict_df(model, parameters): model.pred_df with T_int_pred.
+        to_one_node(parameters): Equivalent R, C, alpha, Pvoisin, time_shift, logged for every family.
+    """
+    name = "1R1C"
+    parameter_names = ["R", "C", "alpha", "Pvoisin", "time_shift"]
+    default_initial_guess = DEFAULT_INITIAL_GUESS
+
+    def predict_arrays(self, arrays, parameters):
+        return predict_arrays(arrays, parameters)
+
+    def custom_loss(self, arrays, parameters):
+        squared_errors = (arrays["temperature_int"] - self.predict_arrays(arrays, parameters)) ** 2
+        return np.nanmean(squared_errors * arrays["loss_weights"])
+
+    def predict_df(self, model, parameters):
+        pred_df = getattr(model, "pred_df", model.features_df)
+        return pred_df.reset_index(drop=True).assign(T_int_pred=self.predict_arrays(model.compile_features(pred_df), parameters))
+
+    def to_one_node(self, parameters):
+        return list(parameters)
+
+
+class TwoNodeModel(OneNodeModel):
+    """
+    2R2C model: the air (Ti, capacity Ci) exchanges with a wall mass (Tw, capacity Cw) through Ri,
+    and the wall with the outside through Re. Heating, radiation and neighbours heat the air:
+        Ci dTi/dt = (Tw - Ti) / Ri + P_consigne * is_heating + alpha * rad + Pvoisin * (15 - Text)
+        Cw dTw/dt = (Ti - Tw) / Ri + (Text - Tw) / Re
+    The 5-minute transition matrices come from one matrix exponential per parameter set (zero order hold).
+    The recurrence is run in the eigenbasis of the transition matrix, as one lfilter per node like the 1-node model.
+    Each day restarts from the measured Ti, the wall starting at the steady conduction profile between Ti and Text.
+    Ri, Re, Ci and Cw must be positive: the loss is infinite otherwise, predict_arrays raises a ValueError.
+    """
+    name = "2R2C"
+    parameter_names = ["Ri", "Re", "Ci", "Cw", "alpha", "Pvoisin", "time_shift"]
+    default_initial_guess = [2e-3, 8e-3, 1e6, 1e7, 87, 65.5, 2]
+
+    @staticmethod
+    def discretize(parameters, dt=TIME_STEP):
+        """Transition matrices (Ad, Bd) of x = [Ti, Tw] for inputs u = [Text, heat to the air]."""
+        Ri, Re, Ci, Cw = parameters[:4]
+        A = np.array([
+            [-1 / (Ri * Ci), 1 / (Ri * Ci)],
+            [1 / (Ri * Cw), -1 / (Ri * Cw) - 1 / (Re * Cw)],
+        ])
+        B = np.array([
+            [0, 1 / Ci],
+            [1 / (Re * Cw), 0],
+        ])
+        augmented = np.zeros((4, 4))
+        augmented[:2, :2] = A
+        augmented[:2, 2:] = B
+        transition = expm(augmented * dt)
+        return transition[:2, :2], transition[:2, 2:]
+
+    @staticmethod
+    def is_physical(parameters):
+        return bool(np.all(np.asarray(parameters[:4], dtype=np.float64) > 0))
+
+    def custom_loss(self, arrays, parameters):
+        if not self.is_physical(parameters):
+            return np.inf
+        return super().custom_loss(arrays, parameters)
+
+    def predict_arrays(self, arrays, parameters):
+        Ri, Re, Ci, Cw, alpha, P_voisin, time_shift = parameters[:7]
+        if not self.is_physical(parameters):
+            raise ValueError(f"2R2C resistances and capacities must be positive, got Ri={Ri}, Re={Re}, Ci={Ci}, Cw={Cw}")
+        temperature_ext = arrays["temperature_ext"]
+        heat = (
+            arrays["P_consigne"][0] * shift_switch(arrays["is_on"], time_shift) +
+            alpha * arrays["direct_radiation"] +
+            P_voisin * (15 - temperature_ext)
+        )
+        Ad, Bd = self.discretize(parameters)
+        # With positive parameters Ad is similar to a symmetric matrix: real eigenvalues, each mode is a scalar recurrence
+        eigenvalues, eigenvectors = np.linalg.eig(Ad)
+        if not np.allclose(eigenvalues.imag, 0, atol=1e-9):
+            raise ValueError(f"Complex eigenvalues of the 2R2C transition matrix for Ri={Ri}, Re={Re}, Ci={Ci}, Cw={Cw}")
+        eigenvalues, eigenvectors = eigenvalues.real, eigenvectors.real
+        to_modes = np.linalg.inv(eigenvectors)
+        inputs = to_modes @ (Bd @ np.vstack([temperature_ext, heat])) # (2 x rows)
+
+        day_starts = arrays["day_starts"]
+        Ti0 = arrays["temperature_int"][day_starts[:-1]]
+        Text0 = temperature_ext[day_starts[:-1]]
+        Tw0 = (Re * Ti0 + Ri * Text0) / (Ri + Re)
+        inputs[:, day_starts[:-1]] = to_modes @ np.vstack([Ti0, Tw0])
+
+        lengths = np.diff(day_starts)
+        if len(lengths) == 0:
+            return inputs[0]
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        cols = np.arange(len(temperature_ext)) - np.repeat(day_starts[:-1], lengths)
+        Ti = np.zeros(len(temperature_ext))
+        for mode, eigenvalue in enumerate(eigenvalues):
+            padded = np.zeros((len(lengths), lengths.max()))
+            padded[rows, cols] = inputs[mode]
+            Ti += eigenvectors[0, mode] * lfilter([1.0], [1.0, -eigenvalue], padded, axis=1)[rows, cols]
+        return Ti
+
+    def to_one_node(self, parameters):
+        Ri, Re, Ci, Cw, alpha, P_voisin, time_shift = parameters[:7]
+        return [Ri + Re, Ci + Cw, alpha, P_voisin, time_shift]
+
+
+ONE_NODE = OneNodeModel()
+MODEL_FAMILIES = {family.name: family for family in [ONE_NODE, TwoNodeModel()]}
+
 def get_rmse(pred_df):
     squared_errors = (pred_df["temperature_int"] - pred_df["T_int_pred"]) ** 2
     mse = squared_errors.mean()
@@ -257,12 +537,82 @@ def get_custom_loss(pred_df):
     loss = (pred_df["squared_errors"] * pred_df["coef"]).mean()
     return loss
 
-def select_features_from_temperature_window(features_df, temp_min=None, temp_max=None):
-    if (temp_min and temp_max):
-        return features_df.loc[lambda df: (df["all_day_temperature"] > temp_min) & (df["all_day_temperature"] < temp_max)]
-    elif temp_min:
-            return features_df.loc[lambda df: df["all_day_temperature"] > temp_min]
-    elif temp_max:
-        return features_df.loc[lambda df: df["all_day_temperature"] < temp_max]
-    else:
-        return features_df
\ No newline at end of file
+def select_features_from_temperature_window(features_df, temp_min=None, temp_max=None, windows=None, temperature_index=None):
+    """
+    Select the rows whose all_day_temperature is strictly between temp_min and temp_max (a falsy bound is no bound).
+    windows is a list of (temp_min, temp_max) to select their union in one pass, it replaces temp_min and temp_max.
+    temperature_index is the TemperatureWindowIndex of features_df, built on the fly when not given.
+    """
+    windows = windows or [(temp_min, temp_max)]
+    windows = [(temp_min or None, temp_max or None) for temp_min, temp_max in windows]
+    if all(window == (None, None) for window in windows):
+        return features_df
+    if temperature_index is None:
+        temperature_index = TemperatureWindowIndex(features_df)
+    return features_df.iloc[temperature_index.positions(windows)]
+
+
+class TemperatureWindowIndex:
+    """
+    Index of a features_df on all_day_temperature, used to train "expert models" on a temperature window.
+    Rows are grouped in runs of consecutive rows sharing day and all_day_temperature (one run per day in practice),
+    runs are sorted by temperature once, then each window is two binary searches instead of a full scan.
+
+    Attributes:
+        run_starts (np.ndarray): First row position of each run, runs sorted by temperature.
+        run_ends (np.ndarray): Row position after the last row of each run.
+        run_temperatures (np.ndarray): Sorted all_day_temperature of the runs (runs with no temperature are left out).
+    Methods:
+        run_range(temp_min, temp_max): Returns the range of runs strictly inside the window.
+        positions(windows): Returns the sorted row positions selected by a list of (temp_min, temp_max) windows.
+    """
+
+    def __init__(self, features_df):
+        temperatures = features_df["all_day_temperature"].to_numpy(dtype=np.float64)
+        days = pd.DatetimeIndex(features_df["date"]).floor("D").asi8
+        same_temperature = (temperatures[1:] == temperatures[:-1]) | (np.isnan(temperatures[1:]) & np.isnan(temperatures[:-1]))
+        starts = np.flatnonzero(np.r_[True, (days[1:] != days[:-1]) | ~same_temperature]) if len(days) else np.array([], dtype=np.int64)
+        ends = np.r_[starts[1:], len(days)].astype(np.int64)
+        run_temperatures = temperatures[starts]
+        valid = ~np.isnan(run_temperatures)
+        order = np.argsort(run_temperatures[valid], kind="stable")
+        self.run_starts = starts[valid][order]
+        self.run_ends = ends[valid][order]
+        self.run_temperatures = run_temperatures[valid][order]
+
+    def run_range(self, temp_min=None, temp_max=None):
+        lower = 0 if temp_min is None else np.searchsorted(self.run_temperatures, temp_min, side="right")
+        upper = len(self.run_temperatures) if temp_max is None else np.searchsorted(self.run_temperatures, temp_max, side="left")
+        return lower, max(lower, upper)
+
+    def positions(self, windows):
+        runs = np.unique(ranges_positions(*np.array([self.run_range(*window) for window in windows]).reshape(-1, 2).T))
+        starts, ends = self.run_starts[runs], self.run_ends[runs]
+        order = np.argsort(starts)
+        return ranges_positions(starts[order], ends[order])
+
+
+def index_features_df(features_df):
+    """Sort features_df on date and index it by date. The date column is kept, the index is unnamed."""
+    features_df = features_df.sort_values("date")
+    # set_axis keeps the name "date" of the column, which would make "date" both a column and an index level
+    return features_df.set_axis(pd.DatetimeIndex(features_df["date"]), axis=0).rename_axis(None)
+
+def date_index(df):
+    if isinstance(df.index, pd.DatetimeIndex):
+        return df.index
+    return pd.DatetimeIndex(df["date"])
+
+def to_index_timestamp(index, date):
+    """Timestamp comparable to index, naive dates being read in the index timezone (as pandas does for strings)."""
+    date = pd.Timestamp(date)
+    if index.tz is not None and date.tzinfo is None:
+        date = date.tz_localize(index.tz)
+    return date
+
+def ranges_positions(starts, ends):
+    """Concatenation of np.arange(start, end) for each pair, without a Python loop."""
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.maximum(np.asarray(ends, dtype=np.int64) - starts, 0)
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
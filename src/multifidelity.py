@@ -0,0 +1,209 @@
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.features import compile_features, custom_loss_arrays, predict_arrays
+from src.optimizer import optimize_parameters
+
+# This file fits the 1R1C model coarse-to-fine: a first optimization runs on an aggregated view of the data
+# (blocks of factor 5-minute rows, e.g. 15 or 30 minutes), then the usual full resolution fit refines from its optimum.
+# On blocks of k rows the recurrence becomes T[j] = a^k * T[j-1] + (1 - a^k) * mean(Tlim) over the block, which is
+# predict_arrays with C / k: the decay factor of a k times longer step. The switch time shift still counts in
+# 5-minute rows: the heating fraction of each block is read from the cumulated switch at the shifted rows.
+# Each day keeps its first row (the measured starting temperature) and drops its incomplete last block.
+# Blocks blur the time shift, so the refine stage first scans the integer shifts within one block of the coarse
+# optimum at full resolution, then runs Powell with the warm start options of get_warm_start_options.
+# Compare with a full resolution only fit: python -m src.multifidelity caussa --factor 3
+
+DEFAULT_FACTOR = 3 # 15-minute blocks, 30-minute blocks (6) can bias R and C beyond what the refine stage recovers
+
+
+def block_bounds(day_starts, factor):
+    """
+    [start, end) fine row positions of the coarse rows: each day's first row alone, then whole blocks of factor rows.
+    Also returns the day_starts of the coarse rows.
+    """
+    starts, ends = [], []
+    for day_start, day_end in zip(day_starts[:-1], day_starts[1:]):
+        n_blocks = (day_end - day_start - 1) // factor
+        block_starts = day_start + 1 + factor * np.arange(n_blocks)
+        starts.append(np.r_[day_start, block_starts])
+        ends.append(np.r_[day_start + 1, block_starts + factor])
+    coarse_day_starts = np.cumsum([0] + [len(day) for day in starts]).astype(np.int64)
+    if not starts:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), coarse_day_starts
+    return np.concatenate(starts).astype(np.int64), np.concatenate(ends).astype(np.int64), coarse_day_starts
+
+
+def block_means(values, starts, ends):
+    """Mean of values over each [start, end) block, NaN when the block holds a NaN."""
+    cumsum = np.r_[0, np.cumsum(np.nan_to_num(values))]
+    nan_count = np.r_[0, np.cumsum(np.isnan(values))]
+    means = (cumsum[ends] - cumsum[starts]) / (ends - starts)
+    return np.where(nan_count[ends] > nan_count[starts], np.nan, means)
+
+
+def coarsen_features(arrays, factor=DEFAULT_FACTOR):
+    """
+    Aggregated view of compiled arrays, usable by predict_arrays with C / factor.
+
+    Args:
+        arrays (dict): Output of compile_features.
+        factor (int): Number of 5-minute rows per block.
+
+    Returns:
+        dict: Arrays keyed like compile_features, one row per block. The measured temperature_int, its loss weight
+            and the date are those of the block's last row. Also holds factor, block_starts / block_ends (fine row
+            positions) and is_on_cumsum (cumulated fine switch) for coarse_is_heating.
+    """
+    starts, ends, day_starts = block_bounds(arrays["day_starts"], factor)
+    last = ends - 1
+    return {
+        "date": arrays["date"][last],
+        "temperature_ext": block_means(arrays["temperature_ext"], starts, ends),
+        "direct_radiation": block_means(arrays["direct_radiation"], starts, ends),
+        "temperature_int": arrays["temperature_int"][last],
+        "loss_weights": arrays["loss_weights"][last],
+        "day_starts": day_starts,
+        "P_consigne": arrays["P_consigne"],
+        "factor": factor,
+        "block_starts": starts,
+        "block_ends": ends,
+        "is_on_cumsum": np.r_[0, np.cumsum(arrays["is_on"], dtype=np.int64)],
+    }
+
+
+def coarse_is_heating(coarse, time_shift):
+    """Fraction of each block during which the switch, shifted by int(time_shift) fine rows, is on."""
+    shift = int(time_shift)
+    cumsum = coarse["is_on_cumsum"]
+    n_rows = len(cumsum) - 1
+    on_rows = (
+        cumsum[np.clip(coarse["block_ends"] - shift, 0, n_rows)] -
+        cumsum[np.clip(coarse["block_starts"] - shift, 0, n_rows)]
+    )
+    return on_rows / (coarse["block_ends"] - coarse["block_starts"])
+
+
+def predict_coarse(coarse, parameters):
+    R, C, alpha, P_voisin, time_shift = parameters[:5]
+    return predict_arrays(coarse, [R, C / coarse["factor"], alpha, P_voisin, time_shift], is_heating=coarse_is_heating(coarse, time_shift))
+
+
+def coarse_loss(coarse, parameters):
+    """custom_loss_arrays on the aggregated view."""
+    squared_errors = (coarse["temperature_int"] - predict_coarse(coarse, parameters)) ** 2
+    return np.nanmean(squared_errors * coarse["loss_weights"])
+
+
+def timed_optimization(loss_function, initial_guess, options=None, log=None):
+    """optimize_parameters returning its successful result with the elapsed seconds, or None."""
+    start_time = time.perf_counter()
+    results = optimize_parameters(loss_function=loss_function, initial_guess=initial_guess, options=options, log=log)
+    for method, result in results.items():
+        if isinstance(result, dict) and result["success"]:
+            return {**result, "seconds": time.perf_counter() - start_time}
+    return None
+
+
+def fit_coarse(arrays, initial_guess, factor=DEFAULT_FACTOR, options=None, log=None):
+    """
+    First stage of a coarse-to-fine fit: optimize on coarsen_features(arrays, factor).
+
+    Returns:
+        dict: optimize_parameters result (parameters, rmse, nfev...) with seconds, or None when the fit failed.
+    """
+    coarse = coarsen_features(arrays, factor)
+    return timed_optimization(lambda parameters: coarse_loss(coarse, parameters), initial_guess, options, log)
+
+
+def scan_time_shift(loss_function, parameters, radius):
+    """
+    Best integer time shift within radius rows of parameters[4], the other parameters fixed.
+    Returns the parameters with the time shift at the middle of the best integer (int() plateau), the loss
+    and the number of loss evaluations.
+    """
+    parameters = np.array(parameters, dtype=np.float64)
+    shifts = int(parameters[4]) + np.arange(-radius, radius + 1)
+    losses = [loss_function(np.r_[parameters[:4], shift]) for shift in shifts]
+    best = int(np.nanargmin(losses))
+    parameters[4] = shifts[best] + (0.5 if shifts[best] >= 0 else -0.5)
+    return parameters, losses[best], len(losses)
+
+
+def fit_refine(loss_function, coarse_parameters, factor=DEFAULT_FACTOR, log=None):
+    """
+    Second stage of a coarse-to-fine fit, on the full resolution loss_function: time shift scan, then warm Powell.
+
+    Returns:
+        dict: optimize_parameters result with seconds, nfev including the scan, or None when the fit failed.
+    """
+    from src.model import get_warm_start_options
+
+    start_time = time.perf_counter()
+    parameters, _, scan_nfev = scan_time_shift(loss_function, coarse_parameters, radius=factor)
+    result = timed_optimization(loss_function, parameters, get_warm_start_options(parameters), log)
+    if result is None:
+        return None
+    return {**result, "nfev": result["nfev"] + scan_nfev, "seconds": time.perf_counter() - start_time}
+
+
+def compare_fidelities(arrays, initial_guess, factor=DEFAULT_FACTOR, options=None, log=None):
+    """
+    Run a coarse-to-fine fit and a full resolution only fit from the same initial guess, both on compiled arrays.
+
+    Returns:
+        pd.DataFrame: One row per stage (coarse, refine, coarse-to-fine total, full only) with nfev, seconds,
+            ms per loss evaluation, the full resolution loss of the stage's parameters and the parameters.
+            A failed stage has no row, nor has the coarse-to-fine total then.
+    """
+    fine_loss = lambda parameters: custom_loss_arrays(arrays, parameters)
+    coarse = fit_coarse(arrays, initial_guess, factor, options, log)
+    refine = None if coarse is None else fit_refine(fine_loss, coarse["parameters"], factor, log)
+    full = timed_optimization(fine_loss, initial_guess, options, log)
+    stages = {f"coarse x{factor}": coarse, "refine": refine}
+    if coarse is not None and refine is not None:
+        stages["coarse-to-fine"] = {
+            "nfev": coarse["nfev"] + refine["nfev"],
+            "seconds": coarse["seconds"] + refine["seconds"],
+            "parameters": refine["parameters"],
+        }
+    stages["full only"] = full
+    return pd.DataFrame([
+        {
+            "stage": stage,
+            "nfev": result["nfev"],
+            "seconds": result["seconds"],
+            "ms_per_eval": result["seconds"] / result["nfev"] * 1e3,
+            "full_loss": fine_loss(result["parameters"]),
+            "parameters": [float(p) for p in result["parameters"]],
+        }
+        for stage, result in stages.items() if result is not None
+    ], columns=["stage", "nfev", "seconds", "ms_per_eval", "full_loss", "parameters"]).set_index("stage")
+
+
+def main():
+    from src.model import DEFAULT_INITIAL_GUESS, TemperatureModel
+
+    parser = argparse.ArgumentParser(description="Compare a coarse-to-fine fit with a full resolution only fit.")
+    parser.add_argument("module")
+    parser.add_argument("--config", default="config.json")
+    parser.add_argument("--factor", type=int, default=DEFAULT_FACTOR, help="5-minute rows per coarse block")
+    parser.add_argument("--last-n-days", type=int, default=None, help="Only fit on the newest N days of data")
+    args = parser.parse_args()
+
+    config = json.load(open(args.config, "r"))
+    model = TemperatureModel(config[args.module])
+    features_df = model.features_df
+    if args.last_n_days:
+        features_df = model.select_last_days(features_df, args.last_n_days)
+    arrays = compile_features(features_df, model.P_consigne)
+    with pd.option_context("display.width", 200, "display.max_columns", None, "display.max_colwidth", 80):
+        print(compare_fidelities(arrays, DEFAULT_INITIAL_GUESS, args.factor, log=lambda message: None))
+
+
+if __name__ == "__main__":
+    main()
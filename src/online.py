@@ -0,0 +1,177 @@
+from collections import deque
+
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+from src.features import TIME_STEP
+from src.model import TemperatureModel, compute_temperature_int, date_index
+from src.utils import get_latest_parameters
+
+# This file keeps the RC state of a home up to date sample by sample, instead of rerunning
+# TemperatureModel.predict over the whole history. Each 5-minute sample costs O(1) and a forecast
+# from the current state costs O(horizon), so live predictions for many homes stay cheap.
+
+
+class OnlineStateTracker:
+    """
+    Online version of the RC model for one home, with an optional Kalman correction on measured temperatures.
+
+    Attributes:
+        parameters (list): R, C, alpha, Pvoisin, time_shift, as logged in runs.csv.
+        P_consigne (float): Consigne power value.
+        temperature_int (float): Current estimate of the internal temperature.
+        variance (float): Variance of that estimate (°C²), only meaningful with Kalman correction.
+        process_noise (float): Variance added to the estimate at each 5-minute step.
+        measurement_noise (float): Variance of the temperature_int sensor. None disables the correction,
+            the state then restarts from the measurement at each new day, exactly as TemperatureModel.predict.
+        date (pd.Timestamp): Date of the last ingested sample.
+    Methods:
+        update(...): Ingests one sample (weather, switch and/or measured temperature).
+        forecast(hours, ...): Predicts the next hours from the current state.
+        from_model(model, parameters): Builds a tracker from a TemperatureModel, replaying its latest day.
+        from_module(module_config, parameters=None): Same from config.json, with the latest logged parameters.
+    """
+
+    def __init__(self, parameters, P_consigne, temperature_int=None, process_noise=1e-3, measurement_noise=4e-2):
+        self.parameters = list(parameters)
+        self.P_consigne = P_consigne
+        self.temperature_int = temperature_int
+        self.variance = 0.0 if temperature_int is not None else np.inf
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.temperature_ext = None
+        self.direct_radiation = 0.0
+        self.date = None
+        # Switch states of the last time_shift + 1 steps, the model heats with the state of time_shift steps ago
+        self.switch_history = deque([0] * (self.time_shift + 1), maxlen=self.time_shift + 1)
+
+    @property
+    def time_shift(self):
+        return max(int(self.parameters[4]), 0)
+
+    def compute_Tlim(self, temperature_ext, direct_radiation, is_heating):
+        R, C, alpha, P_voisin = self.parameters[:4]
+        return temperature_ext + R * (
+            self.P_consigne * is_heating +
+            alpha * direct_radiation +
+            P_voisin * (15 - temperature_ext)
+        )
+
+    def update(self, date=None, temperature_ext=None, direct_radiation=None, switch_state=None, temperature_int=None):
+        """
+        Ingest one sample. Missing inputs keep their last value, as the 5-minute resampling does.
+
+        Args:
+            date: Sample date. The step length is taken from the previous sample, 300 s when unknown.
+            temperature_ext (float): External temperature.
+            direct_radiation (float): Direct radiation, already scaled as in prepare_weather_df.
+            switch_state (str): "on" or "off".
+            temperature_int (float): Measured internal temperature.
+
+        Returns:
+            float: Internal temperature estimate after the sample.
+        """
+        date = pd.Timestamp(date) if date is not None else None
+        step = TIME_STEP
+        if date is not None and self.date is not None:
+            step = (date - self.date).total_seconds()
+        new_day = date is not None and (self.date is None or date.floor("D") != self.date.floor("D"))
+        if date is not None:
+            self.date = date
+        elif self.date is not None:
+            self.date += pd.Timedelta(seconds=step)
+        if is_value(temperature_ext):
+            self.temperature_ext = temperature_ext
+        if is_value(direct_radiation):
+            self.direct_radiation = direct_radiation
+        self.switch_history.append(int(switch_state == "on") if switch_state is not None else self.switch_history[-1])
+
+        if self.temperature_int is not None and self.temperature_ext is not None and step > 0:
+            Tlim = self.compute_Tlim(self.temperature_ext, self.direct_radiation, self.switch_history[0])
+            self.temperature_int = compute_temperature_int(t=step, T0=self.temperature_int, Tlim=Tlim, R=self.parameters[0], C=self.parameters[1])
+            decay = np.exp(-step / (self.parameters[0] * self.parameters[1]))
+            self.variance = decay ** 2 * self.variance + self.process_noise * step / TIME_STEP
+
+        if is_value(temperature_int):
+            if self.temperature_int is None or np.isinf(self.variance):
+                self.temperature_int, self.variance = temperature_int, 0.0
+            elif self.measurement_noise is None:
+                # No correction: like TemperatureModel.predict, restart from the measurement at each new day
+                if new_day:
+                    self.temperature_int = temperature_int
+            else:
+                gain = self.variance / (self.variance + self.measurement_noise)
+                self.temperature_int += gain * (temperature_int - self.temperature_int)
+                self.variance *= 1 - gain
+        return self.temperature_int
+
+    def forecast(self, hours, temperature_ext=None, direct_radiation=None, switch_states=None):
+        """
+        Predict the internal temperature over the next hours from the current state, in O(horizon).
+
+        Args:
+            hours (float): Forecast horizon.
+            temperature_ext: Scalar or array of one value per 5-minute step, defaults to the last value.
+            direct_radiation: Scalar or array of one value per 5-minute step, defaults to the last value.
+            switch_states: "on"/"off" or array of them per step, defaults to the current switch state.
+
+        Returns:
+            pd.DataFrame: date (when known), temperature_ext, direct_radiation, is_heating, Tlim, T_int_pred.
+        """
+        if self.temperature_int is None or self.temperature_ext is None:
+            raise ValueError("The tracker needs a temperature_int and a temperature_ext sample before forecasting")
+        n_steps = int(round(hours * 3600 / TIME_STEP))
+        temperature_ext = np.broadcast_to(self.temperature_ext if temperature_ext is None else temperature_ext, n_steps).astype(np.float64)
+        direct_radiation = np.broadcast_to(self.direct_radiation if direct_radiation is None else direct_radiation, n_steps).astype(np.float64)
+        if switch_states is None:
+            is_on = np.full(n_steps, self.switch_history[-1])
+        else:
+            is_on = (np.broadcast_to(np.asarray(switch_states, dtype=object), n_steps) == "on").astype(int)
+        # Step k heats with the switch state of time_shift steps before, taken from the history at first
+        is_heating = np.r_[list(self.switch_history)[1:], is_on][:n_steps]
+
+        Tlim = self.compute_Tlim(temperature_ext, direct_radiation, is_heating)
+        decay = np.exp(-TIME_STEP / (self.parameters[0] * self.parameters[1]))
+        T_int_pred, _ = lfilter([1.0], [1.0, -decay], (1 - decay) * Tlim, zi=[decay * self.temperature_int])
+        forecast_df = pd.DataFrame({
+            "temperature_ext": temperature_ext,
+            "direct_radiation": direct_radiation,
+            "is_heating": is_heating,
+            "Tlim": Tlim,
+            "T_int_pred": T_int_pred,
+        })
+        if self.date is not None:
+            forecast_df.insert(0, "date", self.date + pd.to_timedelta(np.arange(1, n_steps + 1) * TIME_STEP, unit="s"))
+        return forecast_df
+
+    @classmethod
+    def from_model(cls, model, parameters, **kwargs):
+        """
+        Build a tracker from a TemperatureModel: the latest day of features_df is replayed sample by sample,
+        starting time_shift steps earlier so that the delayed switch states are known.
+        """
+        features_df = model.features_df
+        tracker = cls(parameters, model.P_consigne, **kwargs)
+        index = date_index(features_df)
+        day_start = index.searchsorted(index[-1].floor("D"))
+        for row in features_df.iloc[max(day_start - tracker.time_shift, 0):].itertuples(index=False):
+            tracker.update(
+                date=row.date,
+                temperature_ext=row.temperature_ext,
+                direct_radiation=row.direct_radiation,
+                switch_state=row.state if isinstance(row.state, str) else None,
+                temperature_int=row.temperature_int,
+            )
+        return tracker
+
+    @classmethod
+    def from_module(cls, module_config, parameters=None, **kwargs):
+        parameters = parameters if parameters is not None else get_latest_parameters(module_config["module_name"])
+        if parameters is None:
+            raise ValueError(f"No logged run for module {module_config["module_name"]}")
+        return cls.from_model(TemperatureModel(module_config), parameters, **kwargs)
+
+
+def is_value(x):
+    return x is not None and not (isinstance(x, float) and np.isnan(x))
@@ -1,6 +1,6 @@
 from scipy.optimize import minimize, differential_evolution
 import time
-import streamlit as st
+from src.ui import st
 
 def create_optimization_function(loss_function, fixed_params):
     """
@@ -21,7 +21,7 @@ def create_optimization_function(loss_function, fixed_params):
         return loss_function(opt_params, **fixed_params)
     return wrapped_loss
 
-def optimize_parameters(loss_function, initial_guess):
+def optimize_parameters(loss_function, initial_guess, options=None, log=None):
     """
     Optimize parameters using multiple methods.
     
@@ -31,6 +31,10 @@ def optimize_parameters(loss_function, initial_guess):
         Your LOSS function
     initial_guess : array-like
         Initial parameter values
+    options : dict, optional
+        Solver options forwarded to scipy.optimize.minimize (e.g. direc, xtol, ftol for Powell)
+    log : callable
+        Where progress messages go, st.markdown by default (logged when headless)
     bounds : list of tuples
         Parameter bounds [(min1, max1), (min2, max2)]
     
@@ -38,6 +42,7 @@ def optimize_parameters(loss_function, initial_guess):
     --------
     dict : Results from different optimization methods
     """
+    log = log or st.markdown
     results = {}
     # Local optimization methods
     local_methods = [
@@ -48,20 +53,21 @@ def optimize_parameters(loss_function, initial_guess):
     for local_method in local_methods:
         try:
             start_time = time.time()
-            st.markdown(f"\nTrying {local_method} optimization...")
-            result = minimize(loss_function, initial_guess, method=local_method)
+            log(f"\nTrying {local_method} optimization...")
+            result = minimize(loss_function, initial_guess, method=local_method, options=options)
             results[local_method] = {
                 'parameters': result.x,
                 'rmse': result.fun,
                 'success': result.success,
-                'message': result.message
+                'message': result.message,
+                'nfev': result.nfev,
             }
             end_time = time.time()
 
             elapsed_time = end_time - start_time
-            st.markdown(f"Time taken: {elapsed_time} seconds")
-            st.markdown(f"{local_method} completed: RMSE = {result.fun:.4f}")
+            log(f"Time taken: {elapsed_time} seconds")
+            log(f"{local_method} completed: RMSE = {result.fun:.4f} ({result.nfev} loss evaluations)")
         except Exception as e:
             results[local_method] = f"Failed: {str(e)}"
-            st.markdown(f"{local_method} failed with error: {str(e)}")    
+            log(f"{local_method} failed with error: {str(e)}")    
     return results
\ No newline at end of file
@@ -0,0 +1,146 @@
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+from src.model import date_index, to_index_timestamp
+from src.ui import st
+
+# This file builds plotly traces for long histories without sending every 5-minute point to the browser:
+# - lines are downsampled to about the chart's pixel width (min/max per bucket or LTTB) and drawn with Scattergl
+# - stacked contributions are averaged in hourly (or coarser) buckets before being drawn as bars
+# Only the visible range is downsampled, so zooming in with zoom_range_slider rebuilds the traces with finer detail.
+
+DEFAULT_N_POINTS = 2000 # points per line, about the width of a wide chart in pixels
+MAX_BARS = 500
+
+
+def minmax_indices(x, y, n_buckets):
+    """
+    Positions of the min and max of y in each of n_buckets equal x intervals, sorted. Peaks survive downsampling.
+    Buckets with only NaN keep one NaN point so that gaps stay visible.
+    """
+    if len(x) <= 2 * n_buckets:
+        return np.arange(len(x))
+    x = np.asarray(x, dtype=np.float64)
+    span = x[-1] - x[0]
+    buckets = np.minimum(((x - x[0]) / span * n_buckets).astype(np.int64), n_buckets - 1) if span > 0 else np.zeros(len(x), dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(x)] - 1
+    by_min = np.lexsort((np.where(np.isnan(y), np.inf, y), buckets))
+    by_max = np.lexsort((np.where(np.isnan(y), -np.inf, y), buckets))
+    return np.unique(np.r_[by_min[starts], by_max[ends]])
+
+
+def lttb_indices(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets: keeps n_out points (first and last included) that best preserve the shape
+    of the line. NaN points are ignored.
+    """
+    valid = np.flatnonzero(~np.isnan(y))
+    if len(valid) <= n_out or n_out < 3:
+        return valid
+    x = np.asarray(x, dtype=np.float64)[valid]
+    y = np.asarray(y, dtype=np.float64)[valid]
+    edges = np.linspace(1, len(x) - 1, n_out - 1).astype(np.int64)
+    selected = [0]
+    for k in range(n_out - 2):
+        start, end = edges[k], edges[k + 1]
+        next_end = edges[k + 2] if k + 2 < len(edges) else len(x)
+        next_x, next_y = x[end:next_end].mean(), y[end:next_end].mean()
+        previous = selected[-1]
+        areas = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous]) -
+            (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        selected.append(start + int(areas.argmax()))
+    selected.append(len(x) - 1)
+    return valid[selected]
+
+
+def select_range(df, x_range=None):
+    """Rows of df (sorted on date) within x_range = [start, end], bounds included, None for no bound."""
+    if x_range is None:
+        return df
+    index = date_index(df)
+    start, end = x_range
+    lower = 0 if start is None else index.searchsorted(to_index_timestamp(index, start), side="left")
+    upper = len(index) if end is None else index.searchsorted(to_index_timestamp(index, end), side="right")
+    return df.iloc[lower:upper]
+
+
+def downsample(df, column, x_range=None, n_points=DEFAULT_N_POINTS, method="minmax"):
+    """
+    Rows of df kept to draw column over x_range with about n_points points.
+
+    Args:
+        df (pd.DataFrame): Sorted on date.
+        column (str): Column to draw.
+        x_range (list): [start, end] visible range, None for the whole df.
+        n_points (int): Target number of points.
+        method (str): "minmax" (keeps every peak, fast) or "lttb" (keeps the visual shape).
+
+    Returns:
+        pd.DataFrame: The selected rows, date and column only.
+    """
+    df = select_range(df, x_range)
+    x = date_index(df).asi8
+    y = df[column].to_numpy(dtype=np.float64)
+    if method == "lttb":
+        positions = lttb_indices(x, y, n_points)
+    elif method == "minmax":
+        positions = minmax_indices(x, y, max(n_points // 2, 1))
+    else:
+        raise ValueError(f"Unknown downsampling method {method}")
+    return pd.DataFrame({"date": date_index(df)[positions], column: y[positions]})
+
+
+def line_traces(df, columns, x_range=None, n_points=DEFAULT_N_POINTS, method="minmax", **scatter_kwargs):
+    """One downsampled go.Scattergl per column."""
+    traces = []
+    for column in columns:
+        points = downsample(df, column, x_range, n_points, method)
+        traces.append(go.Scattergl(x=points["date"], y=points[column], name=column, **scatter_kwargs))
+    return traces
+
+
+def bucket_means(df, columns, x_range=None, max_bars=MAX_BARS):
+    """
+    Mean of columns per hourly bucket over x_range, with longer buckets (whole hours) when there would be
+    more than max_bars. Means keep the stacked height in the units of the 5-minute data.
+
+    Returns:
+        tuple: (DataFrame indexed by bucket start, bucket width as pd.Timedelta)
+    """
+    df = select_range(df, x_range)
+    index = date_index(df)
+    if len(index) == 0:
+        # Empty index of the same (tz-aware) type, so that bar_traces can still shift it by half a bucket
+        return pd.DataFrame(columns=columns, index=index, dtype=np.float64), pd.Timedelta(hours=1)
+    hours = max(int(np.ceil((index[-1] - index[0]) / pd.Timedelta(hours=1) / max_bars)), 1)
+    width = pd.Timedelta(hours=hours)
+    means = df.set_index(index)[columns].resample(width).mean().dropna(how="all")
+    return means, width
+
+
+def bar_traces(df, columns, x_range=None, max_bars=MAX_BARS):
+    """One go.Bar per column with bucket_means values, bars centered on their bucket and as wide as it."""
+    means, width = bucket_means(df, columns, x_range, max_bars)
+    centers = means.index + width / 2
+    return [
+        go.Bar(x=centers, y=means[column], name=column, width=width / pd.Timedelta(milliseconds=1))
+        for column in columns
+    ]
+
+
+def zoom_range_slider(df, key, label="Zoom"):
+    """
+    Date range slider over df, to redraw charts on a narrower range with finer detail.
+    Returns the selected [start, end], or None when df is empty.
+    """
+    index = date_index(df)
+    if len(index) == 0:
+        return None
+    first, last = index[0].to_pydatetime(), index[-1].to_pydatetime()
+    if first == last:
+        return [first, last]
+    return list(st.slider(label, min_value=first, max_value=last, value=(first, last), format="YYYY-MM-DD HH:mm", key=key))
@@ -1,8 +1,10 @@
 import datetime as dt
+import numpy as np
 import pandas as pd
 from src.data_processing import prepare_weather_df
+from src.data_loader import load_entity_data
 from src.model import compute_temperature_int
-import streamlit as st
+from scipy.signal import lfilter
 
 # This file contains the functions to build 24h  signals to feed a simulation. 
 # The main idea is to enable a user - that fed his data to our modelisation and had his thermal parameters learned - to launch 24h simulations with imagined or forecasted data.
@@ -21,7 +23,7 @@ class Simulation:
 
     def load_forecasted_data(self):
         self.forecasted_data_df = (
-            pd.read_csv(f"data/{self.module_config["db_name"]}/weather.csv")
+            load_entity_data(self.module_config, "weather")
             .pipe(prepare_weather_df)
             .pipe(self.filter_forecast_timeframe)
             .assign(
@@ -135,8 +137,85 @@ class Simulation:
         self.simulation_df["Tlim"] = pd.Series(Tlim)
         self.simulation_df["T_int_pred"] = pd.Series(T_int_pred)
 
+    def build_weather_ensemble(self, n_members=200, temperature_std=1.0, temperature_correlation=0.99, radiation_std=0.3, seed=None, temperature_ext_members=None, direct_radiation_members=None):
+        """
+        Build the weather members of an ensemble simulation, stored as (members x steps) arrays.
+        Forecast members can be given directly (e.g. from an ensemble weather API), one row per member.
+        Otherwise the deterministic forecast of self.features_df is perturbed:
+        - temperature_ext: AR(1) error with stationary std temperature_std and step-to-step correlation
+          temperature_correlation, as forecast errors drift slowly over the day
+        - direct_radiation: one multiplicative factor 1 + N(0, radiation_std) per member (cloud cover error), kept >= 0
+        """
+        n_steps = len(self.features_df.index)
+        rng = np.random.default_rng(seed)
+        if temperature_ext_members is None:
+            innovations = rng.normal(0, temperature_std * np.sqrt(1 - temperature_correlation ** 2), size=(n_members, n_steps))
+            innovations[:, 0] = rng.normal(0, temperature_std, size=n_members)
+            errors = lfilter([1.0], [1.0, -temperature_correlation], innovations, axis=1)
+            temperature_ext_members = self.features_df["temperature_ext"].to_numpy() + errors
+        if direct_radiation_members is None:
+            factors = np.clip(1 + rng.normal(0, radiation_std, size=(len(temperature_ext_members), 1)), 0, None)
+            direct_radiation_members = self.features_df["direct_radiation"].to_numpy() * factors
+        self.temperature_ext_members = np.asarray(temperature_ext_members, dtype=np.float64)
+        self.direct_radiation_members = np.asarray(direct_radiation_members, dtype=np.float64)
+
+    def compute_ensemble_temperature_int(self):
+        """
+        Same model and thermostat as compute_temperature_int, run on every weather member at once:
+        the loop goes over the 288 time steps only, each step being vectorized over the members.
+        """
+        self.ensemble_is_heating, self.ensemble_T_int_pred = simulate_batch(
+            temperature_ext=self.temperature_ext_members,
+            direct_radiation=self.direct_radiation_members,
+            thermostat_on=(self.features_df["thermostat_state"] == "on").to_numpy()[None, :],
+            parameters=[self.parameters],
+            P_consigne=self.P_consigne,
+            temperature_int_0=self.temperature_int_0,
+            target_temperature=self.target_temperature,
+            hysteresis=self.hysteresis,
+        )
+
+    def compute_ensemble_kpis(self):
+        """
+        Consumption and comfort KPIs of each member of the ensemble.
+        Returns a DataFrame with one row per member:
+        - conso: consumption in kWh, as compute_scenarios_consumption
+        - discomfort: degree-hours below target_temperature - hysteresis while the thermostat is on
+        - min_temperature: lowest internal temperature while the thermostat is on (NaN if never on)
+        """
+        thermostat_on = (self.features_df["thermostat_state"] == "on").to_numpy()
+        uptime = self.ensemble_is_heating.sum(axis=1) * 300 / 3600
+        shortfall = np.clip(self.target_temperature - self.hysteresis - self.ensemble_T_int_pred, 0, None)
+        on_temperatures = np.where(thermostat_on, self.ensemble_T_int_pred, np.nan)
+        return pd.DataFrame({
+            "conso": uptime * self.P_consigne / 1000,
+            "discomfort": (shortfall * thermostat_on).sum(axis=1) * 300 / 3600,
+            "min_temperature": np.nanmin(on_temperatures, axis=1) if thermostat_on.any() else np.nan,
+        })
+
+    def compute_scenarios_ensemble(self, scenarios=("teletravail", "normal", "off"), quantiles=(0.05, 0.5, 0.95), **ensemble_kwargs):
+        """
+        Run the weather ensemble for each heating scenario and return KPI quantiles, one row per (scenario, quantile).
+        All scenarios share the same weather members so that their differences are not blurred by sampling noise.
+        ensemble_kwargs are passed to build_weather_ensemble.
+        """
+        features_df = getattr(self, "features_df", None)
+        rows = []
+        for i, scenario in enumerate(scenarios):
+            self.create_simulation_features(heating_scenario=scenario)
+            if i == 0:
+                self.build_weather_ensemble(**ensemble_kwargs)
+            self.compute_ensemble_temperature_int()
+            kpis = self.compute_ensemble_kpis().quantile(list(quantiles))
+            rows.append(kpis.assign(scenario=scenario).rename_axis("quantile").reset_index())
+        if features_df is not None:
+            self.features_df = features_df
+        return pd.concat(rows, ignore_index=True).set_index(["scenario", "quantile"]).round(2)
+
     def build_scenario(self, heating_scenario: str):
-        if heating_scenario == "teletravail":
+        if isinstance(heating_scenario, pd.DataFrame): # custom schedule: hour, minute, thermostat_state rows
+            scenario_df = heating_scenario
+        elif heating_scenario == "teletravail":
             scenario_df = pd.DataFrame([
                 [9, 0, "on"],
                 [22, 0, "off"]
@@ -169,3 +248,48 @@ class Simulation:
         uptime = self.simulation_df.is_heating.sum() * 300 / 3600 # Convert to hours
         conso = uptime * self.P_consigne / 1000 # Convert to kWh
         return round(conso, 2)
+
+
+def simulate_batch(temperature_ext, direct_radiation, thermostat_on, parameters, P_consigne, temperature_int_0, target_temperature, hysteresis):
+    """
+    Thermostat simulation of Simulation.compute_temperature_int for K independent runs at once, the loop going
+    over the time steps only. Every argument is broadcast to K runs: weather and thermostat_on as (K x steps)
+    arrays, parameters as (K x 5), the others as K values. Runs may differ in weather, scenario, parameters
+    (including time_shift) and thermostat settings.
+
+    Returns:
+        tuple: (is_heating, T_int_pred), both (K x steps) arrays.
+    """
+    parameters = np.atleast_2d(np.asarray(parameters, dtype=np.float64))
+    temperature_ext = np.atleast_2d(np.asarray(temperature_ext, dtype=np.float64))
+    direct_radiation = np.atleast_2d(np.asarray(direct_radiation, dtype=np.float64))
+    thermostat_on = np.atleast_2d(np.asarray(thermostat_on, dtype=bool))
+    n_runs = max(len(parameters), len(temperature_ext), len(direct_radiation), len(thermostat_on))
+    n_steps = temperature_ext.shape[1]
+    temperature_ext = np.broadcast_to(temperature_ext, (n_runs, n_steps))
+    direct_radiation = np.broadcast_to(direct_radiation, (n_runs, n_steps))
+    thermostat_on = np.broadcast_to(thermostat_on, (n_runs, n_steps))
+    parameters = np.broadcast_to(parameters, (n_runs, parameters.shape[1]))
+    R, C, alpha, P_voisin = (parameters[:, k] for k in range(4))
+    time_shift = np.maximum(parameters[:, 4].astype(int), 1)
+    P_consigne, low, high = (np.broadcast_to(np.asarray(x, dtype=np.float64), n_runs) for x in (
+        P_consigne, np.subtract(target_temperature, hysteresis), np.add(target_temperature, hysteresis)
+    ))
+    decay = np.exp(-300 / (R * C))
+    runs = np.arange(n_runs)
+
+    is_heating = np.zeros((n_runs, n_steps), dtype=np.int64)
+    T_int_pred = np.empty((n_runs, n_steps))
+    T_int_pred[:, 0] = temperature_int_0
+    for i in range(1, n_steps):
+        active = (i >= time_shift) & thermostat_on[:, i]
+        if active.any():
+            T_delayed = T_int_pred[runs, np.maximum(i - time_shift, 0)]
+            is_heating[:, i] = active & np.where(is_heating[:, i - 1] == 0, T_delayed <= low, T_delayed < high)
+        Tlim = temperature_ext[:, i] + R * (
+            P_consigne * is_heating[:, i] +
+            alpha * direct_radiation[:, i] +
+            P_voisin * (15 - temperature_ext[:, i])
+        )
+        T_int_pred[:, i] = Tlim + (T_int_pred[:, i - 1] - Tlim) * decay
+    return is_heating, T_int_pred
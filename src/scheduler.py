@@ -0,0 +1,230 @@
+import argparse
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from concurrent.futures import CancelledError, ProcessPoolExecutor, as_completed
+from multiprocessing import Manager
+
+from src.data_loader import populate_database
+from src.features import custom_loss_arrays
+from src.model import RUNS_LOG_PATH, TemperatureModel
+from src.optimizer import optimize_parameters
+from src.tracing import module_tags, traced
+
+# This file trains a whole fleet of modules without the Streamlit app, typically from a nightly cron job.
+# Every module of config.json becomes a job, jobs are sorted longest first and packed on a process pool.
+# Workers only fit: the runs.csv rows are written by the parent process, one at a time.
+
+logger = logging.getLogger(__name__)
+
+
+class FitInterrupted(Exception):
+    """Raised from inside the loss function to stop a running fit (timeout or cancellation)."""
+
+
+def estimate_job_cost(module_config):
+    """
+    Estimate the cost of fitting a module from the number of rows of its CSV files.
+    Lines are counted without parsing so planning hundreds of modules stays cheap.
+
+    Args:
+        module_config (dict): Configuration dictionary containing module-specific settings.
+
+    Returns:
+        int: Total number of data rows for the module.
+    """
+    cost = 0
+    for name in list(module_config["entities"]) + ["weather"]:
+        csv_path = f"data/{module_config["db_name"]}/{name}.csv"
+        if os.path.exists(csv_path):
+            with open(csv_path, "rb") as f:
+                cost += max(sum(1 for _ in f) - 1, 0)
+    return cost
+
+
+def guard_loss(loss_function, deadline=None, cancel_event=None):
+    """
+    Wrap loss_function so that the optimizer stops as soon as the deadline is passed or cancel_event is set.
+    """
+    def guarded_loss(parameters):
+        if cancel_event is not None and cancel_event.is_set():
+            raise FitInterrupted("cancelled")
+        if deadline is not None and time.monotonic() > deadline:
+            raise FitInterrupted("timeout")
+        return loss_function(parameters)
+    return guarded_loss
+
+
+@traced(tags=module_tags)
+def fit_module(module_config, warm_start=False, last_n_days=None, timeout=None, cancel_event=None):
+    """
+    Fit one module headlessly. Runs inside a worker process.
+
+    Args:
+        module_config (dict): Configuration dictionary containing module-specific settings.
+        warm_start (bool): Seed the optimizer from the module's most recent logged run.
+        last_n_days (int): Only fit on the newest last_n_days of data.
+        timeout (float): Maximum fitting time in seconds, counted from the moment the job starts.
+        cancel_event: Shared event, the fit stops at the next loss evaluation once it is set.
+
+    Returns:
+        dict: Job report. "log_row" holds the runs.csv row when the fit succeeded.
+    """
+    start_time = time.monotonic()
+    deadline = start_time + timeout if timeout else None
+    report = {
+        "module_name": module_config["module_name"],
+        "status": "failed",
+        "parameters": None,
+        "loss": None,
+        "nfev": None,
+        "elapsed": None,
+        "message": "",
+        "log_row": None,
+    }
+    try:
+        model = TemperatureModel(module_config)
+        model.pred_df = model.features_df
+        if last_n_days:
+            model.pred_df = model.select_last_days(model.pred_df, last_n_days)
+        initial_guess, options = model.get_initial_guess(warm_start)
+        # The loss runs on arrays compiled once, not on the pred_df DataFrame at every evaluation
+        arrays = model.compile_features(model.pred_df)
+        results = optimize_parameters(
+            loss_function=guard_loss(lambda parameters: custom_loss_arrays(arrays, parameters), deadline, cancel_event),
+            initial_guess=initial_guess,
+            options=options,
+            log=logger.info,
+        )
+        for method, result in results.items():
+            if isinstance(result, dict) and result["success"]:
+                model.optimal_parameters = result["parameters"]
+                report.update(
+                    status="done",
+                    parameters=[float(p) for p in result["parameters"]],
+                    loss=float(result["rmse"]),
+                    nfev=result["nfev"],
+                    message=method,
+                )
+            else:
+                report["message"] = str(result)
+        if report["status"] == "done":
+            report["log_row"] = model.build_run_log(None, None, None, nfev=report["nfev"])
+        elif cancel_event is not None and cancel_event.is_set():
+            report["status"] = "cancelled"
+        elif deadline is not None and time.monotonic() > deadline:
+            report["status"] = "timeout"
+    except Exception as e:
+        report["message"] = f"Failed: {e}"
+    report["elapsed"] = time.monotonic() - start_time
+    return report
+
+
+class FleetScheduler:
+    """
+    Train many modules in parallel, longest job first.
+
+    Attributes:
+        module_configs (list): Module configurations, as defined in config.json.
+        max_workers (int): Size of the process pool, defaults to the number of cores.
+        timeout (float): Per-module fitting timeout in seconds, None for no limit.
+        warm_start (bool): Seed every fit from the module's most recent logged run.
+        last_n_days (int): Only fit on the newest last_n_days of data.
+        log_path (str): runs.csv file where successful fits are written.
+    Methods:
+        plan(): Returns the jobs as (cost, module_config) sorted by decreasing cost.
+        run(): Runs every job and returns one report per module.
+        cancel(): Drops pending jobs and stops running ones at their next loss evaluation.
+    """
+
+    def __init__(self, module_configs, max_workers=None, timeout=None, warm_start=False, last_n_days=None, log_path=RUNS_LOG_PATH):
+        self.module_configs = list(module_configs)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.warm_start = warm_start
+        self.last_n_days = last_n_days
+        self.log_path = log_path
+        self._cancelled = threading.Event()
+        self._cancel_event = None
+        self._futures = {}
+
+    def plan(self):
+        jobs = [(estimate_job_cost(module_config), module_config) for module_config in self.module_configs]
+        return sorted(jobs, key=lambda job: job[0], reverse=True)
+
+    def cancel(self):
+        self._cancelled.set()
+        if self._cancel_event is not None:
+            self._cancel_event.set()
+        for future in list(self._futures):
+            future.cancel()
+
+    def run(self):
+        jobs = self.plan()
+        reports = []
+        with Manager() as manager, ProcessPoolExecutor(max_workers=min(self.max_workers, max(len(jobs), 1))) as executor:
+            self._cancel_event = manager.Event()
+            if self._cancelled.is_set():
+                self._cancel_event.set()
+            # The executor starts jobs in submission order, so submitting by decreasing cost is longest-job-first
+            for cost, module_config in jobs:
+                future = executor.submit(
+                    fit_module,
+                    module_config,
+                    warm_start=self.warm_start,
+                    last_n_days=self.last_n_days,
+                    timeout=self.timeout,
+                    cancel_event=self._cancel_event,
+                )
+                self._futures[future] = module_config
+            if self._cancelled.is_set():
+                self.cancel()
+            for future in as_completed(self._futures):
+                module_name = self._futures[future]["module_name"]
+                try:
+                    report = future.result()
+                except CancelledError:
+                    report = {"module_name": module_name, "status": "cancelled", "message": "Cancelled before start"}
+                except Exception as e:
+                    report = {"module_name": module_name, "status": "failed", "message": f"Failed: {e}"}
+                log_row = report.pop("log_row", None)
+                if log_row is not None:
+                    populate_database(log_row, self.log_path)
+                logger.info(f"{module_name}: {report['status']} {report.get('message', '')}")
+                reports.append(report)
+            self._cancel_event = None
+        self._futures = {}
+        return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train every module of config.json on a process pool.")
+    parser.add_argument("modules", nargs="*", help="Modules to train, all modules of the config by default")
+    parser.add_argument("--config", default="config.json")
+    parser.add_argument("--workers", type=int, default=None, help="Process pool size, defaults to the number of cores")
+    parser.add_argument("--timeout", type=float, default=None, help="Per-module timeout in seconds")
+    parser.add_argument("--warm-start", action="store_true", help="Refit from each module's latest logged run")
+    parser.add_argument("--last-n-days", type=int, default=None, help="Only fit on the newest N days of data")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    config = json.load(open(args.config, "r"))
+    module_names = args.modules or list(config.keys())
+    scheduler = FleetScheduler(
+        [config[module_name] for module_name in module_names],
+        max_workers=args.workers,
+        timeout=args.timeout,
+        warm_start=args.warm_start,
+        last_n_days=args.last_n_days,
+    )
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.cancel())
+    reports = scheduler.run()
+    for report in reports:
+        print(f"{report['module_name']:<20} {report['status']:<10} nfev={report.get('nfev')} elapsed={report.get('elapsed')}")
+
+
+if __name__ == "__main__":
+    main()
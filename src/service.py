@@ -0,0 +1,418 @@
+import argparse
+import datetime as dt
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+
+from src.binary_store import to_epoch_ns
+from src.data_loader import get_data_version
+from src.features import predict_arrays
+from src.model import RUNS_LOG_PATH, TemperatureModel
+from src.sandbox import Simulation, simulate_batch
+from src.utils import prepare_logs
+
+# This file serves the model over HTTP for local clients (Home Assistant automations, scripts), without Streamlit.
+# Endpoints, for any module of config.json:
+# - GET  /modules                          modules of config.json
+# - GET  /modules/<module>/parameters      latest logged parameters
+# - POST /modules/<module>/predict         T_int_pred on the stored history, {"parameters", "start", "end"} all optional
+# - POST /modules/<module>/simulate        24h simulation of tomorrow, {"scenario" or "schedule", "parameters",
+#                                          "target_temperature", "hysteresis", "temperature_int_0"} all optional
+# Compiled features of the most recently used modules stay in memory (LRU), and concurrent simulate requests
+# are grouped into one vectorized simulate_batch run. Requests are validated one by one before the batch, so that
+# an invalid request only fails itself, never the requests batched with it.
+# Run with: python -m src.service --port 8000
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 4
+BATCH_WAIT = 0.005 # seconds a simulate request waits for others to join its batch
+MAX_BATCH_SIZE = 256
+
+
+class ServiceError(Exception):
+    """Error returned to the client with an HTTP status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ModelCache:
+    """
+    LRU cache of the per-module data needed by the endpoints: compiled features for predict, tomorrow's
+    forecast for simulate. An entry is rebuilt when the module's data version or the day changes: "tomorrow"
+    moves at midnight even when no new data was stored.
+
+    Attributes:
+        config (dict): Content of config.json.
+        max_size (int): Number of modules kept in memory.
+    Methods:
+        get(module_name): Returns the entry of a module, loading it when missing or outdated.
+    """
+
+    def __init__(self, config, max_size=DEFAULT_CACHE_SIZE):
+        self.config = config
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.loading_locks = defaultdict(threading.Lock)
+
+    def get(self, module_name):
+        if module_name not in self.config:
+            raise ServiceError(404, f"Unknown module {module_name}")
+        data_version = (get_data_version(self.config[module_name]), current_days())
+        with self.loading_locks[module_name]: # a module is loaded once even when requested concurrently
+            with self.lock:
+                entry = self.entries.get(module_name)
+                if entry is not None and entry["data_version"] == data_version:
+                    self.entries.move_to_end(module_name)
+                    return entry
+            entry = self.load(module_name, data_version)
+            with self.lock:
+                self.entries[module_name] = entry
+                self.entries.move_to_end(module_name)
+                while len(self.entries) > self.max_size:
+                    evicted, _ = self.entries.popitem(last=False)
+                    logger.info(f"Evicted {evicted} from the model cache")
+            return entry
+
+    def load(self, module_name, data_version):
+        start_time = time.time()
+        module_config = self.config[module_name]
+        model = TemperatureModel(module_config)
+        simulation = Simulation(module_config)
+        simulation.load_forecasted_data()
+        logger.info(f"Loaded {module_name} in {time.time() - start_time:.2f} s")
+        return {
+            "data_version": data_version,
+            "arrays": model.compile_features(),
+            "simulation": simulation,
+            "scenarios": {}, # thermostat_on arrays by scenario
+        }
+
+
+class SimulationBatcher:
+    """
+    Groups simulate requests arriving within BATCH_WAIT seconds of each other and runs each group in one
+    simulate_batch call per module.
+
+    Methods:
+        submit(module_name, request): Queues a request, returns a Future of its result.
+    """
+
+    def __init__(self, cache, max_wait=BATCH_WAIT, max_batch_size=MAX_BATCH_SIZE):
+        self.cache = cache
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+        self.requests = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, module_name, request):
+        future = Future()
+        self.requests.put((module_name, request, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.requests.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            by_module = defaultdict(list)
+            for module_name, request, future in batch:
+                by_module[module_name].append((request, future))
+            for module_name, jobs in by_module.items():
+                try:
+                    results = simulate_requests(self.cache.get(module_name), [request for request, future in jobs])
+                except Exception as e:
+                    for request, future in jobs:
+                        future.set_exception(e)
+                    continue
+                for (request, future), result in zip(jobs, results):
+                    future.set_result(result)
+
+
+# runs.csv read once per modification instead of once per request
+_runs_cache = {"mtime": None, "log_runs": None}
+
+def get_log_runs():
+    mtime = os.stat(RUNS_LOG_PATH).st_mtime_ns
+    if _runs_cache["mtime"] != mtime:
+        _runs_cache["log_runs"], _runs_cache["mtime"] = prepare_logs(), mtime
+    return _runs_cache["log_runs"]
+
+
+def latest_parameters(module_name):
+    log_runs = get_log_runs()
+    log_runs = log_runs[(log_runs["module_name"] == module_name) & (log_runs["model"] == "1R1C")]
+    if len(log_runs.index) == 0:
+        raise ServiceError(404, f"No logged run for module {module_name}")
+    run = log_runs.sort_values("date").iloc[-1]
+    return {"module_name": module_name, "date": run["date"].isoformat(), "parameters": run["parameters"], "rmse": run["rmse"]}
+
+
+def current_days():
+    """UTC date and local date (the one Simulation.filter_forecast_timeframe reads tomorrow from)."""
+    return str(dt.datetime.now(dt.timezone.utc).date()), str(dt.date.today())
+
+
+def get_epoch_ns(request, name):
+    """Date field of the request as epoch ns, None when missing."""
+    if request.get(name) is None:
+        return None
+    try:
+        return to_epoch_ns(request[name])
+    except (TypeError, ValueError) as e: # pandas DateParseError is a ValueError
+        raise ServiceError(400, f"{name} is not a valid date: {e}")
+
+
+def get_parameters(module_name, request):
+    """Parameters of the request, the module's latest logged parameters by default."""
+    parameters = request.get("parameters")
+    if parameters is None:
+        parameters = latest_parameters(module_name)["parameters"]
+    try:
+        parameters = [float(x) for x in parameters]
+    except (TypeError, ValueError):
+        parameters = None
+    if parameters is None or len(parameters) != 5 or not np.isfinite(parameters).all():
+        raise ServiceError(400, "parameters must be [R, C, alpha, Pvoisin, time_shift]")
+    return parameters
+
+
+def get_number(request, name, default):
+    """Numeric field of the request, default when missing."""
+    try:
+        value = float(request.get(name, default))
+    except (TypeError, ValueError):
+        value = np.nan
+    if not np.isfinite(value):
+        raise ServiceError(400, f"{name} must be a number")
+    return value
+
+
+def predict(entry, module_name, request):
+    arrays = entry["arrays"]
+    parameters = get_parameters(module_name, request)
+    start, end = get_epoch_ns(request, "start"), get_epoch_ns(request, "end")
+    T_int_pred = predict_arrays(arrays, parameters)
+    dates = pd.to_datetime(arrays["date"], utc=True)
+    lower = 0 if start is None else int(np.searchsorted(arrays["date"], start))
+    upper = len(dates) if end is None else int(np.searchsorted(arrays["date"], end))
+    residuals = arrays["temperature_int"][lower:upper] - T_int_pred[lower:upper]
+    return {
+        "module_name": module_name,
+        "parameters": parameters,
+        "rmse": float(np.sqrt(np.nanmean(residuals ** 2))) if upper > lower else None,
+        "date": [date.isoformat() for date in dates[lower:upper]],
+        "temperature_int": arrays["temperature_int"][lower:upper],
+        "T_int_pred": T_int_pred[lower:upper],
+    }
+
+
+def scenario_thermostat_on(entry, request):
+    """thermostat_on array of the request's scenario, built once per named scenario."""
+    simulation = entry["simulation"]
+    if request.get("schedule") is not None:
+        try:
+            scenario = pd.DataFrame(request["schedule"], columns=["hour", "minute", "thermostat_state"]).astype({"hour": int, "minute": int})
+        except (ValueError, TypeError):
+            raise ServiceError(400, "schedule must be a list of [hour, minute, \"on\" or \"off\"]")
+        simulation.create_simulation_features(heating_scenario=scenario)
+        return (simulation.features_df["thermostat_state"] == "on").to_numpy()
+    name = request.get("scenario", "normal")
+    if name not in entry["scenarios"]:
+        if name not in ("teletravail", "normal", "off"):
+            raise ServiceError(400, f"Unknown scenario {name}")
+        simulation.create_simulation_features(heating_scenario=name)
+        entry["scenarios"][name] = (simulation.features_df["thermostat_state"] == "on").to_numpy()
+    return entry["scenarios"][name]
+
+
+def simulate_runs(simulation, runs):
+    """simulate_batch of validated runs, returns one (parameters, is_heating, T_int_pred) per run."""
+    weather = simulation.forecasted_data_df
+    thermostat_on, parameters, temperature_int_0, target_temperature, hysteresis = (np.array(x) for x in zip(*runs))
+    is_heating, T_int_pred = simulate_batch(
+        temperature_ext=weather["temperature_ext"].to_numpy()[None, :],
+        direct_radiation=weather["direct_radiation"].to_numpy()[None, :],
+        thermostat_on=thermostat_on,
+        parameters=parameters,
+        P_consigne=simulation.P_consigne,
+        temperature_int_0=temperature_int_0,
+        target_temperature=target_temperature,
+        hysteresis=hysteresis,
+    )
+    return list(zip(parameters, is_heating, T_int_pred))
+
+
+def simulate_requests(entry, requests):
+    """
+    Run the simulate requests of one module in one simulate_batch call, returns one result (or error) each.
+    A request that fails validation gets its own error. Should the batch still fail, its requests are simulated
+    one at a time, so that only the failing ones get an error.
+    """
+    simulation = entry["simulation"]
+    weather = simulation.forecasted_data_df
+    if len(weather.index) == 0:
+        error = ServiceError(404, "No weather forecast for tomorrow, update the module's data")
+        return [{"error": error} for request in requests]
+    runs, results = [], []
+    for request in requests:
+        try:
+            runs.append((
+                scenario_thermostat_on(entry, request),
+                get_parameters(simulation.module_config["module_name"], request),
+                get_number(request, "temperature_int_0", simulation.temperature_int_0),
+                get_number(request, "target_temperature", simulation.target_temperature),
+                get_number(request, "hysteresis", simulation.hysteresis),
+            ))
+            results.append({})
+        except ServiceError as e:
+            results.append({"error": e})
+        except Exception as e:
+            logger.exception("Invalid simulate request")
+            results.append({"error": ServiceError(500, str(e))})
+    if not runs:
+        return results
+    try:
+        outputs = simulate_runs(simulation, runs)
+    except Exception:
+        logger.exception("Batched simulation failed, simulating its requests one at a time")
+        outputs = []
+        for run in runs:
+            try:
+                outputs += simulate_runs(simulation, [run])
+            except Exception as e:
+                outputs.append(ServiceError(500, str(e)))
+    dates = [date.isoformat() for date in weather["date"]]
+    outputs = iter(outputs)
+    for result in results:
+        if "error" in result:
+            continue
+        output = next(outputs)
+        if isinstance(output, ServiceError):
+            result["error"] = output
+            continue
+        parameters, is_heating, T_int_pred = output
+        result.update({
+            "parameters": list(parameters),
+            "conso": round(is_heating.sum() * 300 / 3600 * simulation.P_consigne / 1000, 2),
+            "date": dates,
+            "is_heating": is_heating,
+            "T_int_pred": T_int_pred,
+        })
+    return results
+
+
+def to_json(value):
+    """JSON text of a response, numpy arrays as lists and NaN as null."""
+    def convert(x):
+        if isinstance(x, dict):
+            return {key: convert(v) for key, v in x.items()}
+        if isinstance(x, (list, tuple, np.ndarray)):
+            return [convert(v) for v in x]
+        if isinstance(x, (np.integer, np.bool_)):
+            return x.item()
+        if isinstance(x, (float, np.floating)):
+            return None if np.isnan(x) else float(x)
+        return x
+    return json.dumps(convert(value))
+
+
+class ModelServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128 # concurrent clients must not be refused while requests wait for their batch
+
+
+def build_handler(cache, batcher):
+    class RequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.respond(self.route("GET", {}))
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                request = json.loads(self.rfile.read(length) or b"{}")
+            except json.JSONDecodeError:
+                return self.respond(ServiceError(400, "Invalid JSON body"))
+            self.respond(self.route("POST", request))
+
+        def route(self, method, request):
+            parts = [part for part in urlparse(self.path).path.split("/") if part]
+            try:
+                if method == "GET" and parts == ["modules"]:
+                    return {"modules": list(cache.config.keys())}
+                if len(parts) == 3 and parts[0] == "modules":
+                    module_name, action = parts[1], parts[2]
+                    if method == "GET" and action == "parameters":
+                        return latest_parameters(module_name)
+                    if method == "POST" and action == "predict":
+                        return predict(cache.get(module_name), module_name, request)
+                    if method == "POST" and action == "simulate":
+                        result = batcher.submit(module_name, request).result()
+                        return result.get("error", result)
+                raise ServiceError(404, f"No endpoint {method} {self.path}")
+            except ServiceError as e:
+                return e
+            except Exception as e:
+                logger.exception(f"{method} {self.path} failed")
+                return ServiceError(500, str(e))
+
+        def respond(self, result):
+            status = 200
+            if isinstance(result, ServiceError):
+                status, result = result.status, {"error": str(result)}
+            body = to_json(result).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return RequestHandler
+
+
+def serve(config, host="127.0.0.1", port=8000, cache_size=DEFAULT_CACHE_SIZE):
+    cache = ModelCache(config, max_size=cache_size)
+    server = ModelServer((host, port), build_handler(cache, SimulationBatcher(cache)))
+    logger.info(f"Serving on http://{host}:{server.server_port}")
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve predictions and simulations of the modules of config.json over HTTP.")
+    parser.add_argument("--config", default="config.json")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE, help="Number of modules kept in memory")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    config = json.load(open(args.config, "r"))
+    server = serve(config, args.host, args.port, args.cache_size)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
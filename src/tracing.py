@@ -0,0 +1,266 @@
+import argparse
+import contextvars
+import datetime as dt
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError: # not available on Windows, peak RSS is then left empty
+    resource = None
+
+# This file traces the data pipeline (update_db -> populate_database -> load_data -> preprocess_data ->
+# build_features_df -> predict -> fit -> log_run) to find the stage that gets slow when a home's history grows.
+# Functions evaluated thousands of times by a fit (predict) are only traced outside a fit span, see traced(skip_within).
+# Stages open nested spans; each span records its wall and CPU time, the process peak RSS, a row count and tags
+# (module, entity, ...) inherited from its parent span. Finished spans are appended to a JSONL file.
+# Tracing is off by default: span() then returns a shared no-op object and traced functions are called directly.
+# Enable it with enable_tracing() or the THERMAL_TRACE environment variable ("1" or the path of the traces file),
+# which also reaches the scheduler's worker processes.
+# Summary: python -m src.tracing [--module caussa]
+
+TRACES_PATH = "data/logs/traces.jsonl"
+TRACE_ENV = "THERMAL_TRACE"
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_write_lock = threading.Lock()
+_traces_path = None # None when tracing is off
+
+
+def enable_tracing(path=TRACES_PATH):
+    global _traces_path
+    _traces_path = path
+
+
+def disable_tracing():
+    global _traces_path
+    _traces_path = None
+
+
+def tracing_enabled():
+    return _traces_path is not None
+
+
+if os.environ.get(TRACE_ENV):
+    enable_tracing(TRACES_PATH if os.environ[TRACE_ENV] == "1" else os.environ[TRACE_ENV])
+
+
+def peak_rss_mb():
+    """Peak resident memory of the process so far, in MB."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kB on Linux
+
+
+class Span:
+    """
+    One traced stage, used as a context manager.
+
+    Attributes:
+        name (str): Stage name.
+        tags (dict): Tags of the span, the parent's tags included.
+        rows (int): Number of rows handled by the stage, set with set(rows=...).
+        path (str): Names of the enclosing spans and of this one, joined with "/".
+    Methods:
+        set(rows=None, **tags): Sets the row count and adds tags while the span is open.
+    """
+
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+        self.rows = None
+
+    def set(self, rows=None, **tags):
+        if rows is not None:
+            self.rows = int(rows)
+        self.tags.update(tags)
+        return self
+
+    def __enter__(self):
+        parent = _current_span.get()
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.trace_id = parent.trace_id if parent else self.span_id
+        self.path = f"{parent.path}/{self.name}" if parent else self.name
+        self.tags = {**(parent.tags if parent else {}), **self.tags}
+        self.start = dt.datetime.now(dt.timezone.utc)
+        self.peak_rss_start = peak_rss_mb()
+        self._token = _current_span.set(self)
+        # Thread CPU time: in the HTTP service, concurrent requests do not count in each other's spans
+        self._cpu_start = time.thread_time()
+        self._wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self._wall_start
+        cpu = time.thread_time() - self._cpu_start
+        _current_span.reset(self._token)
+        peak_rss = peak_rss_mb()
+        write_span({
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "path": self.path,
+            "start": self.start.isoformat(),
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "peak_rss_mb": peak_rss,
+            "rss_growth_mb": None if peak_rss is None else peak_rss - self.peak_rss_start,
+            "rows": self.rows,
+            "error": exc_type.__name__ if exc_type else None,
+            "pid": os.getpid(),
+            **{f"tag_{key}": value for key, value in self.tags.items()},
+        })
+        return False
+
+
+class NoSpan:
+    """Stands for Span when tracing is off: every method does nothing."""
+
+    def set(self, rows=None, **tags):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+def span(name, **tags):
+    """Context manager tracing the enclosed code as the stage name."""
+    if _traces_path is None:
+        return NO_SPAN
+    return Span(name, tags)
+
+
+def current_span():
+    """Innermost open span, to set its row count from inside a traced function. NO_SPAN when there is none."""
+    if _traces_path is None:
+        return NO_SPAN
+    return _current_span.get() or NO_SPAN
+
+
+def count_rows(result):
+    """Row count of a DataFrame or array result, None for anything else."""
+    if hasattr(result, "shape") and len(getattr(result, "shape", ())) > 0:
+        return result.shape[0]
+    return None
+
+
+def module_tags(module_config, *args, **kwargs):
+    """Tags of functions taking a module_config first, for traced(tags=...)."""
+    return {"module": module_config["module_name"]}
+
+
+def entity_tags(module_config, entity, *args, **kwargs):
+    return {"module": module_config["module_name"], "entity": entity}
+
+
+def within_span(name):
+    """True when a span called name is open, in the current context."""
+    parent = _current_span.get()
+    return parent is not None and name in parent.path.split("/")
+
+
+def traced(name=None, tags=None, skip_within=None):
+    """
+    Decorator tracing each call of a function as a span.
+
+    Args:
+        name (str): Span name, the function name by default.
+        tags (callable): Called with the function's arguments, returns the tags of the span
+            (e.g. lambda module_config, *args, **kwargs: {"module": module_config["module_name"]}).
+        skip_within (str): Calls made while a span of this name is open are not traced, e.g. "fit" for a
+            function a fit evaluates once per loss evaluation.
+    The row count defaults to the length of a DataFrame or array result, see current_span to set it otherwise.
+    """
+    def decorator(function):
+        span_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _traces_path is None or (skip_within is not None and within_span(skip_within)):
+                return function(*args, **kwargs)
+            with Span(span_name, tags(*args, **kwargs) if tags else {}) as s:
+                result = function(*args, **kwargs)
+                if s.rows is None:
+                    s.set(rows=count_rows(result))
+                return result
+        return wrapper
+    return decorator
+
+
+def write_span(record):
+    line = json.dumps(record, default=str) + "\n"
+    with _write_lock:
+        os.makedirs(os.path.dirname(_traces_path) or ".", exist_ok=True)
+        with open(_traces_path, "a") as f:
+            f.write(line)
+
+
+def load_traces(path=TRACES_PATH):
+    """Spans of the traces file as a DataFrame, one row per span."""
+    if not os.path.exists(path):
+        return pd.DataFrame()
+    return pd.read_json(path, lines=True)
+
+
+def summarize_traces(traces, by=("path",)):
+    """
+    Time and memory per stage.
+
+    Args:
+        traces (pd.DataFrame): Spans from load_traces.
+        by (tuple): Columns to group on, e.g. ("path",) or ("tag_module", "name").
+
+    Returns:
+        pd.DataFrame: Per group, number of calls, total/mean/max wall time, total CPU time, self time (wall time
+            not spent in child spans), largest peak RSS and its growth inside the stage, and mean rows.
+            Sorted by total self time: the first rows are where the time goes.
+    """
+    if len(traces.index) == 0:
+        return pd.DataFrame()
+    children_wall = traces.groupby("parent_id")["wall_s"].sum()
+    traces = traces.assign(self_s=traces["wall_s"] - traces["span_id"].map(children_wall).fillna(0))
+    summary = traces.groupby(list(by), dropna=False).agg(
+        calls=("span_id", "count"),
+        wall_total_s=("wall_s", "sum"),
+        wall_mean_s=("wall_s", "mean"),
+        wall_max_s=("wall_s", "max"),
+        cpu_total_s=("cpu_s", "sum"),
+        self_total_s=("self_s", "sum"),
+        peak_rss_mb=("peak_rss_mb", "max"),
+        rss_growth_mb=("rss_growth_mb", "max"),
+        rows_mean=("rows", "mean"),
+        errors=("error", "count"),
+    )
+    return summary.sort_values("self_total_s", ascending=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the pipeline traces.")
+    parser.add_argument("--path", default=TRACES_PATH)
+    parser.add_argument("--module", default=None, help="Only the spans tagged with this module")
+    parser.add_argument("--by", nargs="+", default=["path"], help="Columns to group on, e.g. tag_module name")
+    args = parser.parse_args()
+
+    traces = load_traces(args.path)
+    if args.module is not None and "tag_module" in traces.columns:
+        traces = traces[traces["tag_module"] == args.module]
+    with pd.option_context("display.width", 200, "display.max_columns", None, "display.float_format", "{:.3f}".format):
+        print(summarize_traces(traces, by=args.by))
+
+
+if __name__ == "__main__":
+    main()
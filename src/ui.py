@@ -0,0 +1,79 @@
+import logging
+import os
+import sys
+
+# This file is the only link between src/ and the Streamlit UI. src modules call st.<method> through the proxy
+# below and never import streamlit themselves, so headless runs (cron jobs, workers, the HTTP service) do not
+# pay the import of the UI stack:
+# - in the app, streamlit is already imported by the pages and the proxy forwards every call to it
+# - headless, messages (markdown, warning, error, ...) go to logging and display calls (dataframe, charts) do nothing
+# Secrets (Home Assistant tokens) come from get_secret, whose provider can be replaced with set_secrets_provider.
+
+logger = logging.getLogger(__name__)
+
+# Streamlit message functions and the log level they map to when headless
+MESSAGE_LEVELS = {
+    "title": logging.INFO,
+    "header": logging.INFO,
+    "subheader": logging.INFO,
+    "markdown": logging.INFO,
+    "write": logging.INFO,
+    "text": logging.INFO,
+    "info": logging.INFO,
+    "success": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+}
+SECRETS_PATHS = [os.path.join(os.path.expanduser("~"), ".streamlit", "secrets.toml"), os.path.join(".streamlit", "secrets.toml")]
+
+
+def streamlit_running():
+    """True when the Streamlit app (or any caller) has already imported streamlit."""
+    return "streamlit" in sys.modules
+
+
+class StreamlitProxy:
+    """Stands for the streamlit module in src/, see the header of this file."""
+
+    def __getattr__(self, name):
+        if streamlit_running():
+            return getattr(sys.modules["streamlit"], name)
+        if name in MESSAGE_LEVELS:
+            return lambda body="", *args, **kwargs: logger.log(MESSAGE_LEVELS[name], body)
+        return lambda *args, **kwargs: None
+
+
+st = StreamlitProxy()
+
+
+def read_secrets_files(paths=SECRETS_PATHS):
+    """Same files as st.secrets, read without streamlit. Later files override earlier ones."""
+    import tomllib
+
+    secrets = {}
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                secrets.update(tomllib.load(f))
+    return secrets
+
+
+def default_secrets_provider(key):
+    """Environment variable first, then st.secrets in the app, then the Streamlit secrets files."""
+    if key in os.environ:
+        return os.environ[key]
+    if streamlit_running():
+        return sys.modules["streamlit"].secrets[key]
+    return read_secrets_files()[key]
+
+
+_secrets_provider = default_secrets_provider
+
+def set_secrets_provider(provider):
+    """Replace the secrets provider, a callable key -> secret raising KeyError when missing."""
+    global _secrets_provider
+    _secrets_provider = provider or default_secrets_provider
+
+
+def get_secret(key):
+    return _secrets_provider(key)
@@ -0,0 +1,195 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from src.features import custom_loss_arrays, predict_arrays, predict_arrays_batch
+from src.optimizer import optimize_parameters
+
+# This file estimates how well a fit determines R, C, alpha and Pvoisin, from the curvature of the custom loss
+# at the optimum. Every loss evaluation of the report (Hessian stencil and profile grids) goes through
+# predict_arrays_batch in a single call, so the report costs about as much as a few loss evaluations.
+# time_shift is an integer number of steps, the loss is flat between two values: it is kept fixed.
+
+logger = logging.getLogger(__name__)
+
+PARAMETER_NAMES = ["R", "C", "alpha", "Pvoisin"]
+CHI2_95 = 3.84 # delta chi2 of a 95% confidence interval on one parameter
+
+
+def custom_loss_batch(arrays, parameters):
+    """custom_loss_arrays for K parameter sets at once, returns K losses."""
+    squared_errors = (arrays["temperature_int"][None, :] - predict_arrays_batch(arrays, parameters)) ** 2
+    return np.nanmean(squared_errors * arrays["loss_weights"][None, :], axis=1)
+
+
+def parameter_scales(parameters):
+    """Scale of each fitted parameter, the Hessian is computed on parameters / scale to be well conditioned."""
+    scales = np.abs(np.asarray(parameters[:len(PARAMETER_NAMES)], dtype=np.float64))
+    return np.where(scales > 0, scales, 1.0)
+
+
+def to_parameters(parameters, scaled_offsets):
+    """(K x 4) offsets in scaled units around parameters, as (K x 5) parameter sets with the same time_shift."""
+    scaled_offsets = np.atleast_2d(scaled_offsets)
+    batch = np.tile(np.asarray(parameters, dtype=np.float64), (len(scaled_offsets), 1))
+    batch[:, :len(PARAMETER_NAMES)] += scaled_offsets * parameter_scales(parameters)
+    return batch
+
+
+def loss_hessian(arrays, parameters, relative_step=1e-3):
+    """
+    Central finite difference Hessian of the custom loss in scaled units, from 1 + 2n + 2n(n-1) loss evaluations
+    done in one batch.
+
+    Returns:
+        tuple: (Hessian (4 x 4), loss at parameters)
+    """
+    n = len(PARAMETER_NAMES)
+    h = relative_step
+    offsets = [np.zeros(n)]
+    for i in range(n):
+        for sign in (1, -1):
+            offsets.append(sign * h * np.eye(n)[i])
+    pairs = [(i, j) for i in range(n) for j in range(i + 1, n)]
+    for i, j in pairs:
+        for sign_i, sign_j in ((1, 1), (1, -1), (-1, 1), (-1, -1)):
+            offsets.append(h * (sign_i * np.eye(n)[i] + sign_j * np.eye(n)[j]))
+    losses = custom_loss_batch(arrays, to_parameters(parameters, np.array(offsets)))
+
+    loss = losses[0]
+    hessian = np.zeros((n, n))
+    for i in range(n):
+        hessian[i, i] = (losses[1 + 2 * i] - 2 * loss + losses[2 + 2 * i]) / h ** 2
+    for k, (i, j) in enumerate(pairs):
+        f_pp, f_pm, f_mp, f_mm = losses[1 + 2 * n + 4 * k:5 + 2 * n + 4 * k]
+        hessian[i, j] = hessian[j, i] = (f_pp - f_pm - f_mp + f_mm) / (4 * h ** 2)
+    return hessian, loss
+
+
+def effective_sample_size(residuals):
+    """
+    Number of independent residuals: 5-minute residuals are strongly autocorrelated, so the raw count would
+    give far too narrow intervals. Uses the AR(1) approximation n * (1 - rho) / (1 + rho).
+    """
+    residuals = residuals[~np.isnan(residuals)]
+    if len(residuals) < 3:
+        return float(len(residuals))
+    centered = residuals - residuals.mean()
+    rho = np.clip(np.sum(centered[1:] * centered[:-1]) / np.sum(centered ** 2), 0, 0.999)
+    return len(residuals) * (1 - rho) / (1 + rho)
+
+
+def profile_offsets(hessian, i, deltas):
+    """
+    Offsets (scaled units) along the profile of parameter i: the other parameters follow their conditional
+    optimum under the quadratic approximation of the loss, -H[-i,-i]^-1 H[-i,i] * delta.
+    """
+    others = [k for k in range(len(hessian)) if k != i]
+    slope = -np.linalg.lstsq(hessian[np.ix_(others, others)], hessian[others, i], rcond=None)[0]
+    offsets = np.zeros((len(deltas), len(hessian)))
+    offsets[:, i] = deltas
+    offsets[:, others] = deltas[:, None] * slope[None, :]
+    return offsets
+
+
+def refine_profile_point(arrays, parameters, i, offset):
+    """Re-optimize the other parameters with parameter i fixed, starting from the quadratic approximation."""
+    others = [k for k in range(len(PARAMETER_NAMES)) if k != i]
+
+    def loss_function(x):
+        point = offset.copy()
+        point[others] = x
+        return custom_loss_arrays(arrays, to_parameters(parameters, point)[0])
+
+    results = optimize_parameters(
+        loss_function=loss_function,
+        initial_guess=offset[others],
+        options={"xtol": 1e-3, "ftol": 1e-4},
+        log=logger.debug,
+    )
+    result = results.get("Powell")
+    if isinstance(result, dict) and result["success"]:
+        offset = offset.copy()
+        offset[others] = result["parameters"]
+    return offset
+
+
+def estimate_uncertainty(arrays, parameters, n_profile_points=11, profile_width=3.0, refine_profiles=False, relative_step=1e-3):
+    """
+    Uncertainty report of a fit on compiled arrays.
+
+    The custom loss L is treated as a Gaussian likelihood, -2 log-likelihood = n_eff * log(L) + constant, with n_eff
+    the effective number of independent residuals. The covariance is then 2 * L / n_eff * H^-1 (H the Hessian of L)
+    and the profile curves are reported as delta chi2 = n_eff * log(L / L_min).
+
+    Args:
+        arrays (dict): Output of compile_features, on the data the parameters were fitted on.
+        parameters (list): R, C, alpha, Pvoisin, time_shift at the optimum.
+        n_profile_points (int): Points of each profile curve.
+        profile_width (float): Half width of the profiles in standard deviations, capped to 90% of the value.
+        refine_profiles (bool): Re-optimize the other parameters at each profile point (slower, exact profile)
+            instead of following the quadratic approximation.
+        relative_step (float): Finite difference step, relative to each parameter.
+
+    Returns:
+        dict:
+            - summary (pd.DataFrame): value, std, relative_std, 95% interval and identifiable flag per parameter
+            - correlation (pd.DataFrame): correlation matrix of the parameters
+            - corr_R_C (float): correlation between R and C
+            - condition_number (float): of the scaled Hessian, large values mean poorly identified combinations
+            - profiles (pd.DataFrame): parameter, value, loss, delta_chi2
+            - n_eff (float), loss (float)
+    """
+    parameters = np.asarray(parameters, dtype=np.float64)
+    n = len(PARAMETER_NAMES)
+    scales = parameter_scales(parameters)
+    hessian, loss = loss_hessian(arrays, parameters, relative_step)
+    n_eff = effective_sample_size(arrays["temperature_int"] - predict_arrays(arrays, parameters))
+
+    eigenvalues = np.linalg.eigvalsh(hessian)
+    positive_definite = eigenvalues.min() > 0
+    covariance = 2 * loss / n_eff * np.linalg.pinv(hessian) # scaled units
+    # Away from a minimum (e.g. parameters fitted on other data) some variances are negative: reported as NaN
+    std = np.sqrt(np.where(np.diag(covariance) > 0, np.diag(covariance), np.nan))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        correlation = covariance / np.outer(std, std)
+        condition_number = eigenvalues.max() / eigenvalues.min() if positive_definite else np.inf
+
+    summary = pd.DataFrame({
+        "parameter": PARAMETER_NAMES,
+        "value": parameters[:n],
+        "std": std * scales,
+        "relative_std": std * scales / np.abs(parameters[:n]),
+        "ci95_low": parameters[:n] - 1.96 * std * scales,
+        "ci95_high": parameters[:n] + 1.96 * std * scales,
+        # A parameter is identified when the loss is curved along it and its interval excludes 0
+        "identifiable": positive_definite & (np.diag(hessian) > 0) & (1.96 * std < 1),
+    })
+
+    offsets = []
+    for i in range(n):
+        width = min(profile_width * std[i], 0.9) if std[i] > 0 else 0.5 # NaN std compares False
+        profile = profile_offsets(hessian, i, np.linspace(-width, width, n_profile_points))
+        if refine_profiles:
+            profile = np.array([refine_profile_point(arrays, parameters, i, offset) for offset in profile])
+        offsets.append(profile)
+    offsets = np.concatenate(offsets)
+    points = to_parameters(parameters, offsets)
+    profile_losses = custom_loss_batch(arrays, points)
+    profiles = pd.DataFrame({
+        "parameter": np.repeat(PARAMETER_NAMES, n_profile_points),
+        "value": points[np.arange(len(points)), np.repeat(np.arange(n), n_profile_points)],
+        "loss": profile_losses,
+        "delta_chi2": n_eff * np.log(profile_losses / loss),
+    })
+
+    return {
+        "summary": summary,
+        "correlation": pd.DataFrame(correlation, index=PARAMETER_NAMES, columns=PARAMETER_NAMES),
+        "corr_R_C": correlation[0, 1],
+        "condition_number": condition_number,
+        "profiles": profiles,
+        "n_eff": n_eff,
+        "loss": loss,
+    }
@@ -1,9 +1,54 @@
 import pandas as pd
 
+EXPERT_MODEL = "1R1C-expert" # model of the runs.csv rows of an ExpertBank, single node runs on one temperature band
+
+def run_models(log_runs):
+    """
+    Model family of each run: runs logged before model families are single node RC runs,
+    rows of an expert bank (with a group_id) are EXPERT_MODEL runs, never full range ones.
+    """
+    models = log_runs["model"] if "model" in log_runs.columns else pd.Series(None, index=log_runs.index, dtype=object)
+    if "group_id" in log_runs.columns:
+        models = models.where(log_runs["group_id"].isna(), EXPERT_MODEL)
+    return models.fillna("1R1C")
+
 def prepare_logs():
     return (
         pd.read_csv("data/logs/runs.csv", sep=',')
         .assign(date=lambda x: pd.to_datetime(x['date']))
         .assign(parameters=lambda x: x[['R', 'C', 'alpha', 'Pvoisin', 'time_shift']].values.tolist())
         .assign(parameters_str=lambda x: x['parameters'].apply(lambda y: f"R={y[0]:.1e}, C={y[1]:.1e}, alpha={y[2]:.1e}, Pvoisin={y[3]:.1e}, delta_t={y[4]:.1e}"))
-    )
\ No newline at end of file
+        .assign(model=run_models)
+    )
+
+def get_params_from_model(log_runs, module_name, model="1R1C", columns=None):
+    """
+    Retrieve the parameters from the most recent model run for a given module.
+
+    Args:
+        log_runs (pd.DataFrame): DataFrame containing log runs.
+        module_name (str): Name of the module for which to retrieve parameters.
+        model (str): Model family of the runs to consider.
+        columns (list): Parameter columns to return, the single node parameters (R, C, alpha, Pvoisin, time_shift) by default.
+
+    Returns:
+        list: List of parameters from the most recent model run for the specified module.
+    """
+    df = (
+        log_runs[(log_runs["module_name"] == module_name) & (log_runs["model"] == model)].copy()
+        .sort_values(by='date', ascending=False)
+        .reset_index(drop=True)
+    )
+    if columns is not None:
+        return df.iloc[0][columns].tolist()
+    return df.iloc[0]['parameters']
+
+def get_latest_parameters(module_name, model="1R1C", columns=None):
+    """
+    Same as get_params_from_model but reads the logs itself.
+    Returns None when the module has never been trained with this model family.
+    """
+    log_runs = prepare_logs()
+    if not ((log_runs["module_name"] == module_name) & (log_runs["model"] == model)).any():
+        return None
+    return get_params_from_model(log_runs, module_name, model, columns)